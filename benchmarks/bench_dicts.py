@@ -0,0 +1,116 @@
+"""
+Benchmarks ``utils.concatenate_dicts`` and ``utils.select_dicts``, which fill preallocated (and
+optionally reused) arrays, against the previous ``np.concatenate`` / ``np.stack`` versions, and
+checks that both give the same outputs.
+
+e.g. python benchmarks/bench_dicts.py --events 100000
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+
+import numpy as np
+
+from hpt.processors import utils
+
+
+def concatenate_dicts_stack(dicts_list):
+    """Previous ``concatenate_dicts``"""
+    if len(dicts_list) > 1:
+        return {
+            key: np.concatenate(
+                [d[key].reshape(d[key].shape[0], -1) for d in dicts_list], axis=1
+            )
+            for key in dicts_list[0]
+        }
+
+    return dicts_list[0]
+
+
+def select_dicts_stack(dicts_list, sel):
+    """Previous ``select_dicts``"""
+    return {
+        key: np.stack([d[key].reshape(d[key].shape[0], -1) for d in dicts_list], axis=1)[sel]
+        for key in dicts_list[0]
+    }
+
+
+def jet_dicts(n_events: int, n_dicts: int, seed: int = 42) -> list[dict[str, np.ndarray]]:
+    """
+    Per-jet dicts of float32 / int / bool variables, e.g. of the two leading fatjets, including
+    variables with a different dtype in each dict (e.g. int in one and float in the others)
+    """
+    rng = np.random.default_rng(seed)
+    dicts = []
+    for i in range(n_dicts):
+        d = {f"ak8FatJet{v}": rng.normal(size=(n_events, 1)).astype(np.float32) for v in range(20)}
+        d["ak8FatJetMatchIndex"] = rng.integers(-1, 4, size=(n_events, 1))
+        d["ak8FatJetMatch"] = rng.uniform(size=n_events) < 0.5
+        match = rng.integers(0, 2, size=(n_events, 1))
+        d["ak8FatJetNumMatched"] = match if i == 0 else match.astype(np.float64)
+        d["ak8FatJetIsMatched"] = match.astype(bool) if i == 0 else match
+        dicts.append(d)
+    return dicts
+
+
+def bench(func, nrepeat: int) -> float:
+    times = []
+    for _ in range(nrepeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def check(result: dict[str, np.ndarray], reference: dict[str, np.ndarray]):
+    for key, ref in reference.items():
+        assert result[key].dtype == ref.dtype, key
+        np.testing.assert_array_equal(result[key], ref, err_msg=key)
+
+
+def main(args):
+    dicts = jet_dicts(args.events, args.dicts)
+    rng = np.random.default_rng(1)
+    sels = {
+        "events": rng.uniform(size=args.events) < 0.5,
+        "jets": rng.uniform(size=(args.events, args.dicts)) < 0.5,
+    }
+    print(f"{args.events} events, {args.dicts} dicts of {len(dicts[0])} keys")
+
+    out = {}
+    funcs = {
+        "concatenate_dicts": (
+            lambda: concatenate_dicts_stack(dicts),
+            lambda: utils.concatenate_dicts(dicts),
+            lambda: utils.concatenate_dicts(dicts, out=out),
+        )
+    }
+    for name, sel in sels.items():
+        funcs[f"select_dicts ({name})"] = (
+            lambda sel=sel: select_dicts_stack(dicts, sel),
+            lambda sel=sel: utils.select_dicts(dicts, sel),
+            lambda sel=sel: utils.select_dicts(dicts, sel, out=out),
+        )
+
+    for name, (previous, preallocated, reused) in funcs.items():
+        out.clear()
+        reference = previous()
+        check(preallocated(), reference)
+        check(reused(), reference)
+
+        times = [bench(func, args.repeat) for func in (previous, preallocated, reused)]
+        print(
+            f"{name:>24}: previous {times[0] * 1000:7.2f} ms, preallocated {times[1] * 1000:7.2f} "
+            f"ms, reused buffers {times[2] * 1000:7.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--events", default=100000, help="number of events", type=int)
+    parser.add_argument("--dicts", default=2, help="number of dicts to combine", type=int)
+    parser.add_argument("--repeat", default=10, help="number of repetitions", type=int)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,248 @@
+"""
+Runs the throughput benchmark (``bench_throughput.py``), stores its results in an SQLite history
+keyed by git commit, and compares them to those of a baseline commit: the run fails if any metric
+(events/s, wall / merge / per-stage times, peak RSS) is significantly worse, per a one-sided
+Welch's t-test over the repetitions.
+
+Results are only compared between runs with the same benchmark arguments. Arguments not known to
+this script are passed on to ``run.py``, e.g.
+
+python benchmarks/bench_history.py --events 100000 --repeat 5 --baseline 1a2b3c4
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import json
+import sqlite3
+import subprocess
+import sys
+from pathlib import Path
+
+import pandas as pd
+from bench_throughput import FLAVOURS, main as bench_throughput
+from scipy import stats
+
+from hpt import run_utils
+
+# metrics for which higher values are better, lower is better for the rest
+HIGHER_IS_BETTER = {"events/s"}
+
+# changes of the times (in s) smaller than this are not regressions, e.g. for very short stages
+MIN_TIME_CHANGE = 0.01
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    commit_hash TEXT,
+    dirty INTEGER,
+    timestamp TEXT,
+    config TEXT,
+    flavour TEXT,
+    metric TEXT,
+    repetition INTEGER,
+    value REAL
+)
+"""
+
+
+def git_commit() -> tuple[str, bool]:
+    """Current commit and whether tracked files have uncommitted changes"""
+    cwd = Path(__file__).resolve().parent
+    commit = subprocess.run(
+        ["git", "rev-parse", "HEAD"], cwd=cwd, capture_output=True, text=True, check=True
+    ).stdout.strip()
+    status = subprocess.run(
+        ["git", "status", "--porcelain", "--untracked-files=no"],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return commit, bool(status.strip())
+
+
+def flatten(results: list[dict]) -> pd.DataFrame:
+    """(flavour, metric, repetition, value) rows of the ``bench_throughput`` results"""
+    rows = []
+    repetitions = {}
+    for result in results:
+        flavour = result["flavour"]
+        repetition = repetitions[flavour] = repetitions.get(flavour, -1) + 1
+        metrics = {
+            key: value
+            for key, value in result.items()
+            if key not in ["flavour", "events", "stages"]
+        }
+        metrics.update({f"{stage} time": value for stage, value in result["stages"].items()})
+        rows.extend((flavour, metric, repetition, float(v)) for metric, v in metrics.items())
+
+    return pd.DataFrame(rows, columns=["flavour", "metric", "repetition", "value"])
+
+
+def save(db: sqlite3.Connection, df: pd.DataFrame, commit: str, dirty: bool, config: str):
+    timestamp = datetime.datetime.now().isoformat(timespec="seconds")
+    db.executemany(
+        "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            (commit, int(dirty), timestamp, config, flavour, metric, repetition, value)
+            for flavour, metric, repetition, value in df.itertuples(index=False)
+        ],
+    )
+    db.commit()
+
+
+def load_baseline(
+    db: sqlite3.Connection, config: str, commit: str, baseline: str | None
+) -> tuple[str | None, pd.DataFrame]:
+    """
+    Results of the ``baseline`` commit (or unique prefix), by default the latest other commit in
+    the history. Runs with uncommitted changes are never used as a baseline.
+    """
+    if baseline is None:
+        query = (
+            "SELECT commit_hash FROM results WHERE config = ? AND dirty = 0 AND commit_hash != ? "
+            "ORDER BY timestamp DESC LIMIT 1"
+        )
+        row = db.execute(query, (config, commit)).fetchone()
+    else:
+        query = (
+            "SELECT DISTINCT commit_hash FROM results "
+            "WHERE config = ? AND dirty = 0 AND commit_hash LIKE ?"
+        )
+        rows = db.execute(query, (config, f"{baseline}%")).fetchall()
+        if len(rows) > 1:
+            raise ValueError(f"Baseline {baseline} matches several commits")
+        row = rows[0] if rows else None
+
+    if row is None:
+        return None, pd.DataFrame(columns=["flavour", "metric", "value"])
+
+    df = pd.read_sql_query(
+        "SELECT flavour, metric, value FROM results "
+        "WHERE config = ? AND dirty = 0 AND commit_hash = ?",
+        db,
+        params=(config, row[0]),
+    )
+    return row[0], df
+
+
+def compare(
+    current: pd.DataFrame, baseline: pd.DataFrame, alpha: float, threshold: float
+) -> pd.DataFrame:
+    """
+    Per flavour and metric: means of the current and baseline results, relative change, and the
+    p-value of the current results being worse. Regressions are changes for the worse larger
+    than ``threshold`` with a p-value below ``alpha``.
+    """
+    rows = []
+    for (flavour, metric), values in current.groupby(["flavour", "metric"], sort=False)["value"]:
+        base = baseline["value"][(baseline["flavour"] == flavour) & (baseline["metric"] == metric)]
+        if base.empty:
+            continue
+
+        worse = "less" if metric in HIGHER_IS_BETTER else "greater"
+        if len(values) > 1 and len(base) > 1 and (values.std() > 0 or base.std() > 0):
+            pvalue = stats.ttest_ind(values, base, equal_var=False, alternative=worse).pvalue
+        else:
+            # too few repetitions to estimate the spread, only the threshold applies
+            pvalue = 0.0 if (values.mean() < base.mean()) == (worse == "less") else 1.0
+
+        change = values.mean() / base.mean() - 1 if base.mean() else 0.0
+        relative_worse = -change if worse == "less" else change
+        if metric.endswith("time") and abs(values.mean() - base.mean()) < MIN_TIME_CHANGE:
+            relative_worse = 0.0
+
+        rows.append(
+            {
+                "flavour": flavour,
+                "metric": metric,
+                "baseline": base.mean(),
+                "current": values.mean(),
+                "change (%)": 100 * change,
+                "p-value": pvalue,
+                "regression": bool(relative_worse > threshold and pvalue < alpha),
+            }
+        )
+
+    return pd.DataFrame(rows)
+
+
+def main(args, run_argv: list[str]):
+    commit, dirty = git_commit()
+    config = json.dumps(
+        {
+            "events": args.events,
+            "chunksize": args.chunksize,
+            "flavours": args.flavours,
+            "run_args": run_argv,
+        }
+    )
+
+    results = bench_throughput(args, run_argv)
+    current = flatten(results)
+
+    with sqlite3.connect(args.db) as db:
+        db.execute(SCHEMA)
+        if args.save:
+            save(db, current, commit, dirty, config)
+        baseline_commit, baseline = load_baseline(db, config, commit, args.baseline)
+
+    if baseline_commit is None:
+        print("No baseline results with the same benchmark arguments to compare to")
+        return
+
+    comparison = compare(current, baseline, args.alpha, args.threshold)
+    print(f"Commit {commit[:10]}{' (dirty)' if dirty else ''} vs. baseline {baseline_commit[:10]}:")
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(comparison.round(3).to_string(index=False))
+
+    regressions = comparison[comparison["regression"]]
+    if not regressions.empty:
+        print(f"{len(regressions)} significant regression(s):")
+        for _, row in regressions.iterrows():
+            print(
+                f"  {row['flavour']} {row['metric']}: {row['change (%)']:+.1f}% "
+                f"(p = {row['p-value']:.3g})"
+            )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--events", default=50000, help="number of events per file", type=int)
+    parser.add_argument("--chunksize", default=10000, help="chunk size", type=int)
+    parser.add_argument(
+        "--flavours", default=FLAVOURS, help="flavours to run", nargs="*", choices=FLAVOURS
+    )
+    parser.add_argument("--repeat", default=5, help="number of repetitions", type=int)
+    parser.add_argument(
+        "--dir",
+        default=None,
+        help="directory in which to keep the generated files between runs (default: temporary)",
+        type=str,
+    )
+    parser.add_argument(
+        "--db",
+        default=str(Path(__file__).resolve().parent / "history.sqlite"),
+        help="SQLite file with the history of the results",
+        type=str,
+    )
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="commit to compare to (default: the latest other commit in the history)",
+        type=str,
+    )
+    parser.add_argument(
+        "--alpha", default=0.01, help="significance level of the regression test", type=float
+    )
+    parser.add_argument(
+        "--threshold",
+        default=0.05,
+        help="minimum relative change for the worse to count as a regression",
+        type=float,
+    )
+    run_utils.add_bool_arg(parser, "save", "add the results to the history", default=True)
+    args, run_argv = parser.parse_known_args()
+    main(args, run_argv)
@@ -0,0 +1,85 @@
+"""
+Benchmarks writing the per-chunk skimmed outputs through pandas (``SkimmerABC.to_pandas``)
+against writing them directly with pyarrow (``SkimmerABC.to_arrow``).
+
+e.g. python benchmarks/bench_output_table.py --events 100000
+"""
+
+from __future__ import annotations
+
+import argparse
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from hpt.processors import ptSkimmer
+
+
+def skimmed_events(n_events: int, seed: int = 42) -> dict[str, np.ndarray]:
+    """Random arrays with the same keys and shapes as the ptSkimmer HHto4B outputs"""
+    rng = np.random.default_rng(seed)
+    shapes = {
+        **{f"GenHiggs{v}": 2 for v in ["Eta", "Phi", "Mass", "Pt"]},
+        **{f"Genb{v}": 4 for v in ["Eta", "Phi", "Mass", "Pt"]},
+        **{f"ak4Jet{v}": 6 for v in ["HiggsMatch", "HiggsMatchIndex", "hadronFlavour"]},
+        **{f"bbFatJet{v}": 2 for v in ["HiggsMatch", "HiggsMatchIndex", "NumBMatchedH1"]},
+        **{f"ak8FatJet{v}": 2 for v in ["Eta", "Phi", "Mass", "Pt", "Msd", "PNetTXbb"]},
+        **{f"ak8FatJet{v}": 2 for v in ["PNetTXjj", "PNetQCD", "PNetMass", "rawFactor"]},
+    }
+    events = {key: rng.normal(size=(n_events, n)) for key, n in shapes.items()}
+    for i in range(25):
+        events[f"HLT_{i}"] = rng.integers(0, 2, size=(n_events, 1))
+    for key in ["weight", "weight_noxsec"]:
+        events[key] = rng.normal(size=(n_events, 1))
+    return events
+
+
+def bench(func, nrepeat: int) -> float:
+    times = []
+    for _ in range(nrepeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(args):
+    skimmer = ptSkimmer()
+    events = skimmed_events(args.events)
+    nbytes = sum(v.nbytes for v in events.values())
+    print(f"{args.events} events, {len(events)} keys, {nbytes / 1024**2:.1f} MB of numpy arrays")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = Path(tmpdir) / "out.parquet"
+        paths = {
+            "pandas": lambda: pa.Table.from_pandas(skimmer.to_pandas(events)),
+            "arrow": lambda: pa.Table.from_batches([skimmer.to_arrow(events)]),
+        }
+
+        for name, convert in paths.items():
+            # extra memory used by the conversion: numpy / pandas copies + pyarrow allocations
+            tracemalloc.start()
+            allocated = pa.total_allocated_bytes()
+            table = convert()
+            copied = tracemalloc.get_traced_memory()[1] + pa.total_allocated_bytes() - allocated
+            tracemalloc.stop()
+            del table
+
+            tconvert = bench(convert, args.repeat)
+            twrite = bench(lambda convert=convert: pq.write_table(convert(), fname), args.repeat)
+            print(
+                f"{name:>8}: convert {tconvert * 1000:8.1f} ms, convert + write {twrite * 1000:8.1f} ms, "
+                f"extra memory {copied / 1024**2:6.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--events", default=10000, help="number of events per chunk", type=int)
+    parser.add_argument("--repeat", default=5, help="number of repetitions", type=int)
+    main(parser.parse_args())
@@ -0,0 +1,127 @@
+"""
+End-to-end throughput of ``ptSkimmer`` through ``run.py``'s ``run()`` on synthetic NanoAOD files
+(see ``synthetic_nano.py``), for each gen selection flavour. Runs fully offline.
+
+Arguments not known to this script are passed on to ``run.py``, e.g.
+
+python benchmarks/bench_throughput.py --events 100000 --executor processes --workers 4
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+from synthetic_nano import DATASETS, FLAVOURS, make_nano
+
+from hpt import run_utils
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+import run  # noqa: E402
+
+YEAR = "2023"
+
+
+def run_args(path: Path, flavour: str, args, run_argv: list[str]) -> argparse.Namespace:
+    """``run.py`` arguments to process the synthetic file ``path``"""
+    parser = argparse.ArgumentParser()
+    run_utils.parse_common_args(parser)
+    run.parse_args(parser)
+    return parser.parse_args(
+        [
+            "--processor",
+            "ptSkimmer",
+            "--year",
+            YEAR,
+            "--files",
+            str(path),
+            "--nano-version",
+            "v12",
+            "--files-name",
+            DATASETS[flavour],
+            "--chunksize",
+            str(args.chunksize),
+            *run_argv,
+        ]
+    )
+
+
+def bench_flavour(path: Path, flavour: str, args, run_argv: list[str]) -> list[dict]:
+    """
+    Runs ``run.py`` on ``path`` ``args.repeat`` times and returns the results of each run,
+    including the processing time of each stage of the processor (in ``"stages"``).
+    """
+    results = []
+    for _ in range(args.repeat):
+        with tempfile.TemporaryDirectory() as workdir:
+            # run() writes its outputs to the working directory
+            cwd = Path.cwd()
+            os.chdir(workdir)
+            try:
+                run_utils.reset_peak_rss()
+                start = time.perf_counter()
+                out, metrics = run.main(run_args(path, flavour, args, run_argv))
+                wall_time = time.perf_counter() - start
+            finally:
+                os.chdir(cwd)
+
+        # chunks processed in worker processes report their own peak RSS
+        peak_rss = max(
+            [run_utils.get_peak_rss()] + [s["peak_rss"] for s in metrics.get("chunk_stats", [])]
+        )
+        results.append(
+            {
+                "flavour": flavour,
+                "events": metrics["entries"],
+                "time": wall_time,
+                "events/s": metrics["entries"] / wall_time,
+                "peak RSS (MB)": peak_rss,
+                "merge time": metrics.get("merge_time", 0.0),
+                "stages": run_utils.timing_summary(out).sum().to_dict(),
+            }
+        )
+
+    return results
+
+
+def main(args, run_argv: list[str]):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_dir = Path(args.dir if args.dir else tmpdir)
+        file_dir.mkdir(parents=True, exist_ok=True)
+
+        results = []
+        for flavour in args.flavours:
+            path = file_dir / f"{flavour}_{args.events}.root"
+            if not path.exists():
+                print(f"Generating {args.events} {flavour} events in {path}")
+                make_nano(str(path), args.events, flavour)
+
+            results.extend(bench_flavour(path, flavour, args, run_argv))
+
+    # fastest run per flavour
+    df = pd.DataFrame(results).drop(columns="stages")
+    print(df.loc[df.groupby("flavour", sort=False)["time"].idxmin()].set_index("flavour").round(2))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--events", default=50000, help="number of events per file", type=int)
+    parser.add_argument("--chunksize", default=10000, help="chunk size", type=int)
+    parser.add_argument(
+        "--flavours", default=FLAVOURS, help="flavours to run", nargs="*", choices=FLAVOURS
+    )
+    parser.add_argument("--repeat", default=1, help="number of repetitions", type=int)
+    parser.add_argument(
+        "--dir",
+        default=None,
+        help="directory in which to keep the generated files between runs (default: temporary)",
+        type=str,
+    )
+    args, run_argv = parser.parse_known_args()
+    main(args, run_argv)
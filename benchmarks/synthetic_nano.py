@@ -0,0 +1,167 @@
+"""
+Generates synthetic NanoAOD-like ROOT files with the branches read by ``ptSkimmer``, to run the
+benchmarks offline: FatJet (with ParticleNet fields), Jet, Electron, Muon, GenPart (with mother
+indices and status flags), HLT and genWeight.
+
+e.g. python benchmarks/synthetic_nano.py HHto4B.root --events 100000 --flavour HHto4B
+"""
+
+from __future__ import annotations
+
+import argparse
+
+import awkward as ak
+import numpy as np
+import uproot
+
+from hpt.processors import ptSkimmer
+
+FLAVOURS = ["HHto4B", "Hto2B", "Zto2Q", "data"]
+
+# dataset names, which select the gen selection of ``ptSkimmer`` through ``gen_selection_dict``
+DATASETS = {
+    "HHto4B": "GluGlutoHHto4B",
+    "Hto2B": "GluGluHto2B",
+    "Zto2Q": "Zto2Q-4Jets",
+    "data": "JetMET",
+}
+
+# fromHardProcess and isLastCopy (``GEN_FLAGS``)
+HARD_PROCESS_FLAGS = (1 << 8) | (1 << 13)
+
+# (pdgId, mother index, mass) of the hard process particles per event
+HARD_PROCESSES = {
+    "HHto4B": [
+        (25, -1, 125.0),
+        (25, -1, 125.0),
+        (5, 0, 4.2),
+        (-5, 0, 4.2),
+        (5, 1, 4.2),
+        (-5, 1, 4.2),
+    ],
+    "Hto2B": [(25, -1, 125.0), (5, 0, 4.2), (-5, 0, 4.2)],
+    "Zto2Q": [(23, -1, 91.2), (1, 0, 0.0), (-1, 0, 0.0)],
+}
+
+# fraction of HH events where the second Higgs decays to cc instead (failing the bbbb selection)
+HH_NON_4B_FRACTION = 0.2
+
+
+def _jagged(rng, counts: np.ndarray, low: float, high: float, dtype=np.float32) -> ak.Array:
+    return ak.unflatten(rng.uniform(low, high, int(counts.sum())).astype(dtype), counts)
+
+
+def _gen_particles(rng, n_events: int, flavour: str) -> ak.Array:
+    """Hard process particles, followed by a random number of soft quarks / gluons"""
+    hard = HARD_PROCESSES[flavour]
+    n_hard = len(hard)
+    n_soft = rng.integers(20, 60, n_events)
+    counts = n_hard + n_soft
+
+    pdg_id = rng.choice([1, 2, 3, 4, 5, 21], int(counts.sum())).astype(np.int32)
+    mother = np.full(int(counts.sum()), -1, np.int32)
+    flags = rng.integers(0, 1 << 8, int(counts.sum())).astype(np.int32)
+    mass = np.zeros(int(counts.sum()), np.float32)
+
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    for i, (pdg, mom, m) in enumerate(hard):
+        pdg_id[offsets + i] = pdg
+        mother[offsets + i] = mom
+        flags[offsets + i] = HARD_PROCESS_FLAGS
+        mass[offsets + i] = m
+
+    if flavour == "HHto4B":
+        non_4b = offsets[rng.uniform(size=n_events) < HH_NON_4B_FRACTION]
+        pdg_id[non_4b + 4] = 4
+        pdg_id[non_4b + 5] = -4
+
+    return ak.zip(
+        {
+            "pdgId": ak.unflatten(pdg_id, counts),
+            "genPartIdxMother": ak.unflatten(mother, counts),
+            "statusFlags": ak.unflatten(flags, counts),
+            "pt": _jagged(rng, counts, 1, 500),
+            "eta": _jagged(rng, counts, -5, 5),
+            "phi": _jagged(rng, counts, -np.pi, np.pi),
+            "mass": ak.unflatten(mass, counts),
+        }
+    )
+
+
+def make_nano(path: str, n_events: int = 10000, flavour: str = "HHto4B", seed: int = 42):
+    """Writes ``n_events`` synthetic events of ``flavour`` (one of ``FLAVOURS``) to ``path``"""
+    rng = np.random.default_rng(seed)
+
+    n_fatjets = rng.integers(0, 4, n_events)
+    fatjets = {
+        "pt": _jagged(rng, n_fatjets, 200, 1000),
+        "eta": _jagged(rng, n_fatjets, -2.5, 2.5),
+        "phi": _jagged(rng, n_fatjets, -np.pi, np.pi),
+        "mass": _jagged(rng, n_fatjets, 20, 250),
+        "msoftdrop": _jagged(rng, n_fatjets, 0, 250),
+        "particleNet_massCorr": _jagged(rng, n_fatjets, 0.8, 1.2),
+        "jetId": ak.unflatten(rng.choice([0, 2, 6], int(n_fatjets.sum())), n_fatjets),
+    }
+    for field in [
+        "tau1",
+        "tau2",
+        "tau3",
+        "rawFactor",
+        "particleNet_XbbVsQCD",
+        "particleNet_XqqVsQCD",
+        "particleNet_QCD",
+        "particleNet_QCD0HF",
+        "particleNet_QCD1HF",
+        "particleNet_QCD2HF",
+    ]:
+        fatjets[field] = _jagged(rng, n_fatjets, 0, 1)
+
+    n_jets = rng.integers(0, 12, n_events)
+    jets = {
+        "pt": _jagged(rng, n_jets, 15, 500),
+        "eta": _jagged(rng, n_jets, -4.7, 4.7),
+        "phi": _jagged(rng, n_jets, -np.pi, np.pi),
+        "mass": _jagged(rng, n_jets, 2, 50),
+        "btagPNetB": _jagged(rng, n_jets, 0, 1),
+        "hadronFlavour": ak.unflatten(rng.choice([0, 4, 5], int(n_jets.sum())), n_jets),
+        "jetId": ak.unflatten(rng.choice([0, 2, 6], int(n_jets.sum())), n_jets),
+    }
+
+    events = {
+        "run": np.ones(n_events, np.uint32),
+        "luminosityBlock": np.ones(n_events, np.uint32),
+        "event": np.arange(n_events, dtype=np.uint64),
+        "FatJet": ak.zip(fatjets),
+        "Jet": ak.zip(jets),
+    }
+
+    for lepton in ["Electron", "Muon"]:
+        n_leptons = rng.integers(0, 3, n_events)
+        events[lepton] = ak.zip(
+            {
+                "pt": _jagged(rng, n_leptons, 5, 200),
+                "eta": _jagged(rng, n_leptons, -2.5, 2.5),
+                "phi": _jagged(rng, n_leptons, -np.pi, np.pi),
+            }
+        )
+
+    # leave out a few triggers, which are then filled with zeros
+    for trigger in ptSkimmer.HLTs[:-3]:
+        events[f"HLT_{trigger}"] = rng.uniform(size=n_events) < 0.3
+
+    if flavour != "data":
+        events["GenPart"] = _gen_particles(rng, n_events, flavour)
+        events["genWeight"] = rng.normal(1, 0.1, n_events).astype(np.float32)
+
+    with uproot.recreate(path) as f:
+        f["Events"] = events
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("path", help="output ROOT file", type=str)
+    parser.add_argument("--events", default=10000, help="number of events", type=int)
+    parser.add_argument("--flavour", default="HHto4B", choices=FLAVOURS, type=str)
+    parser.add_argument("--seed", default=42, help="random seed", type=int)
+    args = parser.parse_args()
+    make_nano(args.path, args.events, args.flavour, args.seed)
@@ -319,6 +319,14 @@ def get_files(dataset, version):
 
         files_rucio, sites = get_dataset_files(dataset, **sites_cfg, output="first")
 
+        # all available replicas of each file, to fail over to if reading a file fails
+        files_all, _ = get_dataset_files(
+            dataset, blacklist_sites=sites_cfg["blacklist_sites"], output="all"
+        )
+        for pfns in files_all:
+            lfn = pfns[0][pfns[0].find("/store/") :]
+            replicas[lfn] = pfns
+
         # print(dataset, sites)
 
         # Get rid of invalid files
@@ -336,6 +344,7 @@ def get_files(dataset, version):
 
 
 for version in ["v12"]:
+    replicas = {}
     datasets = globals()[f"get_{version}"]()
     index = datasets.copy()
     for year, ydict in datasets.items():
@@ -353,3 +362,6 @@ for version in ["v12"]:
 
     with Path(f"nanoindex_{version}.json").open("w") as f:
         json.dump(index, f, indent=4)
+
+    with Path(f"nanoindex_{version}_replicas.json").open("w") as f:
+        json.dump(replicas, f, indent=4)
@@ -31,6 +31,32 @@ def write_template(templ_file: str, out_file: str, templ_args: dict):
         f.write(templ.substitute(templ_args))
 
 
+def fill_metadata_cache(args):
+    """
+    Preprocesses the input files missing from the ``--metadata-cache``, which is then sent to the
+    jobs so that they don't need to open the files to preprocess them.
+    """
+    from coffea import processor
+
+    from hpt.metadata_cache import MetadataCache
+    from hpt.runner import Runner
+
+    fileset = run_utils.get_fileset(
+        args.processor, args.year, args.nano_version, args.samples, args.subsamples
+    )
+
+    metadata_cache = MetadataCache(args.metadata_cache)
+    run = Runner(
+        executor=processor.FuturesExecutor(workers=args.preprocess_workers, status=True),
+        metadata_cache=metadata_cache,
+        # files which can't be opened now are preprocessed in the jobs as before
+        skipbadfiles=True,
+        replicas=run_utils.get_replicas(args.nano_version),
+    )
+    run.preprocess(fileset, "Events")
+    return metadata_cache, fileset
+
+
 def main(args):
     # check that branch exists
     run_utils.check_branch(args.git_branch, args.allow_diff_local_repo)
@@ -79,6 +105,11 @@ def main(args):
 
     print(f"fileset: {fileset}")
 
+    if args.metadata_cache:
+        metadata_cache, files = fill_metadata_cache(args)
+        metadata_cache_file = Path(args.metadata_cache).resolve()
+        print(f"Preprocessing metadata of {len(metadata_cache)} files in {metadata_cache_file}")
+
     jdl_templ = "src/condor/submit.templ.jdl"
     sh_templ = "src/condor/submit.templ.sh"
 
@@ -89,6 +120,15 @@ def main(args):
             if args.submit:
                 print("Submitting " + subsample)
 
+            if args.metadata_cache:
+                nevents = [
+                    metadata_cache.numentries(fname) for fname in files[f"{args.year}_{subsample}"]
+                ]
+                print(
+                    f"{subsample}: {tot_files} files, {sum(n for n in nevents if n is not None)} "
+                    f"events ({nevents.count(None)} files not preprocessed)"
+                )
+
             sample_dir = outdir / args.year / subsample
             njobs = ceil(tot_files / args.files_per_job)
 
@@ -98,7 +138,17 @@ def main(args):
 
                 prefix = f"{args.year}_{subsample}"
                 localcondor = f"{local_dir}/{prefix}_{j}.jdl"
-                jdl_args = {"dir": local_dir, "prefix": prefix, "jobid": j, "proxy": proxy}
+                jdl_args = {
+                    "dir": local_dir,
+                    "prefix": prefix,
+                    "jobid": j,
+                    "proxy": proxy,
+                    "transfer_input_files": (
+                        f"transfer_input_files    = {metadata_cache_file}"
+                        if args.metadata_cache
+                        else ""
+                    ),
+                }
                 write_template(jdl_templ, localcondor, jdl_args)
 
                 localsh = f"{local_dir}/{prefix}_{j}.sh"
@@ -118,6 +168,12 @@ def main(args):
                     "outdir": sample_dir,
                     "jobnum": j,
                     "nano_version": args.nano_version,
+                    # the cache is transferred to the job directory, outside the cloned repo
+                    "metadata_cache": (
+                        f"--metadata-cache ../{metadata_cache_file.name}"
+                        if args.metadata_cache
+                        else ""
+                    ),
                 }
                 write_template(sh_templ, localsh, sh_args)
                 os.system(f"chmod u+x {localsh}")
@@ -162,6 +218,12 @@ def parse_args(parser):
         help="test run or not - test run means only 2 jobs per sample will be created",
     )
     parser.add_argument("--files-per-job", default=20, help="# files per condor job", type=int)
+    parser.add_argument(
+        "--preprocess-workers",
+        default=8,
+        help="processes to preprocess the files missing from the --metadata-cache with",
+        type=int,
+    )
     run_utils.add_bool_arg(
         parser, "submit", default=False, help="submit files as well as create them"
     )
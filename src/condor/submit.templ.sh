@@ -5,7 +5,7 @@
 # pip install --upgrade numpy==1.21.5
 
 # make dir for output
-mkdir outfiles
+mkdir -p outfiles
 
 for t2_prefix in ${t2_prefixes}
 do
@@ -15,6 +15,10 @@ do
     done
 done
 
+# the checkpoints and outputs of completed chunks are kept in the top-level directory: only the
+# files listed in transfer_output_files are spooled on an eviction and restored here after it
+mkdir -p checkpoints outparquet
+
 # try 3 times in case of network errors
 (
     r=3
@@ -26,6 +30,8 @@ done
     done
 )
 cd hpt || exit
+ln -sfn ../checkpoints checkpoints
+ln -sfn ../outparquet outparquet
 
 commithash=$$(git rev-parse HEAD)
 echo "https://github.com/$gituser/hpt/commit/$${commithash}" > commithash.txt
@@ -40,7 +46,7 @@ pip install -e .
 
 # run code
 # pip install --user onnxruntime
-python -u -W ignore $script --year $year --starti $starti --endi $endi --samples $sample --subsamples $subsample --processor $processor --maxchunks $maxchunks --chunksize $chunksize --nano-version ${nano_version} 
+python -u -W ignore $script --year $year --starti $starti --endi $endi --samples $sample --subsamples $subsample --processor $processor --maxchunks $maxchunks --chunksize $chunksize --nano-version ${nano_version} --resume ${metadata_cache}
 
 #move output to t2s
 for t2_prefix in ${t2_prefixes}
@@ -53,3 +59,5 @@ done
 rm *.parquet
 rm *.root
 rm commithash.txt
+# keep the (empty) directories, which are transferred back with transfer_output_files
+rm -rf ../checkpoints/* ../outparquet/*
@@ -0,0 +1,189 @@
+"""
+Local LRU disk cache for remote (xrootd) input files, shared by concurrent workers.
+
+Enable it for all ``uproot.open`` calls of a process with ``set_file_cache(cache_dir, max_size)``.
+"""
+
+from __future__ import annotations
+
+import fcntl
+import hashlib
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import uproot
+
+from .runner import get_lfn
+
+
+def _split_url(url: str) -> tuple[str, str]:
+    """``root://host//path`` -> (``root://host``, ``/path``)"""
+    i = url.index("/", len("root://"))
+    return url[:i], url[i + 1 :] if url[i + 1 : i + 2] == "/" else url[i:]
+
+
+def remote_size(url: str) -> int:
+    """Size in bytes of the file at ``url`` (an xrootd url or a local path)"""
+    if not url.startswith("root://"):
+        return Path(url).stat().st_size
+
+    from XRootD import client
+
+    host, path = _split_url(url)
+    status, info = client.FileSystem(host).stat(path)
+    if not status.ok:
+        raise OSError(f"Could not stat {url}: {status.message}")
+    return info.size
+
+
+def download(url: str, path: Path):
+    """Copies the file at ``url`` (an xrootd url or a local path) to ``path``"""
+    if not url.startswith("root://"):
+        shutil.copyfile(url, path)
+        return
+
+    from XRootD import client
+
+    process = client.CopyProcess()
+    process.add_job(url, str(path), force=True)
+    process.prepare()
+    status, results = process.run()
+    if not status.ok or not results[0]["status"].ok:
+        raise OSError(f"Could not copy {url}: {results[0]['status'].message}")
+
+
+def _open_locked(path: Path, operation: int):
+    """
+    Opens the lock file ``path`` and locks it with ``fcntl.flock(operation)``. Lock files are
+    removed on eviction, so this retries if ``path`` was removed / replaced while waiting.
+    """
+    while True:
+        f = path.open("a")
+        try:
+            fcntl.flock(f, operation)
+            if path.exists() and path.stat().st_ino == os.fstat(f.fileno()).st_ino:
+                return f
+        except BaseException:
+            f.close()
+            raise
+        f.close()
+
+
+@contextmanager
+def _locked(path: Path, shared: bool = False):
+    with _open_locked(path, fcntl.LOCK_SH if shared else fcntl.LOCK_EX) as f:
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class FileCache:
+    """
+    Caches remote files in ``cache_dir``, keyed by their (immutable) logical file name, and evicts
+    the least recently used files once the cache is larger than ``max_size`` (in GB). The size of
+    each copy is checked against the remote file when it is downloaded.
+
+    Each cached file has a lock file: it is downloaded under an exclusive lock, and read under a
+    shared lock, during which it is not evicted, so that several workers / jobs on the same
+    machine can share the cache. The lock file is removed with the evicted file.
+    """
+
+    suffix = ".root"
+
+    def __init__(self, cache_dir: str, max_size: float = 20.0):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size * 1024**3
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, url: str) -> Path:
+        """Path of the cached copy of ``url``"""
+        lfn = get_lfn(url)
+        key = hashlib.sha1(lfn.encode()).hexdigest()[:16]
+        return self.cache_dir / f"{key}_{Path(lfn).stem}{self.suffix}"
+
+    @contextmanager
+    def fetch(self, url: str):
+        """
+        Yields the path of the local copy of ``url``, downloading it if it isn't cached.
+        The copy is not evicted until the context exits, so it should be opened within it.
+        """
+        path = self.path(url)
+        lock = path.with_suffix(".lock")
+
+        while True:
+            with _locked(lock):
+                if path.exists():
+                    # the modification time orders the files for the eviction
+                    os.utime(path)
+                else:
+                    tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+                    try:
+                        download(url, tmp_path)
+                        # the remote file is only stat'ed on a miss
+                        size = remote_size(url)
+                        if tmp_path.stat().st_size != size:
+                            raise OSError(f"Incomplete copy of {url}: expected {size} bytes")
+                        tmp_path.replace(path)
+                    finally:
+                        tmp_path.unlink(missing_ok=True)
+
+            with _locked(lock, shared=True):
+                # check it wasn't evicted in between the locks
+                if path.exists():
+                    # files not in use are evicted to make space
+                    self.evict()
+                    yield str(path)
+                    return
+
+    def evict(self):
+        """Removes the least recently used files until the cache is smaller than ``max_size``"""
+        with _locked(self.cache_dir / ".lock"):
+            files = sorted(
+                (p.stat().st_mtime, p.stat().st_size, p)
+                for p in self.cache_dir.glob(f"*{self.suffix}")
+            )
+            total = sum(size for _, size, _ in files)
+
+            for _, size, path in files:
+                if total <= self.max_size:
+                    break
+
+                lock = path.with_suffix(".lock")
+                try:
+                    # skip files which are being downloaded / read
+                    f = _open_locked(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+
+                with f:
+                    path.unlink()
+                    # processes waiting on the removed lock file retry with a new one
+                    lock.unlink()
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+                total -= size
+
+
+class CachedXRootDSource(uproot.source.file.MemmapSource):
+    """
+    uproot source for xrootd urls, which reads the local copy in the ``FileCache`` at the
+    ``file_cache`` option (with size ``file_cache_size`` in GB).
+    """
+
+    def __init__(self, file_path, **options):
+        cache = FileCache(options["file_cache"], options["file_cache_size"])
+        with cache.fetch(file_path) as local_path:
+            # the file is opened (memory-mapped) within the context, after which it is safe
+            # from the eviction
+            super().__init__(local_path, **options)
+
+
+def set_file_cache(cache_dir: str, max_size: float = 20.0):
+    """Reads all xrootd files opened by uproot in this process through a ``FileCache``"""
+    uproot.open.defaults["xrootd_handler"] = CachedXRootDSource
+    uproot.open.defaults["file_cache"] = cache_dir
+    uproot.open.defaults["file_cache_size"] = max_size
@@ -0,0 +1,53 @@
+"""
+Memory usage of the current process, with only standard library dependencies, so that it can be
+used by both the processors and the job running utilities.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import gc
+import os
+import resource
+from pathlib import Path
+
+
+def get_rss() -> float:
+    """Current resident set size of this process in MB"""
+    try:
+        with Path("/proc/self/statm").open() as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except OSError:
+        # not on linux, fall back to the peak RSS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss() -> bool:
+    """Resets the peak RSS of this process (linux only), returns whether it succeeded"""
+    try:
+        with Path("/proc/self/clear_refs").open("w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss() -> float:
+    """Peak resident set size of this process in MB, since the last ``reset_peak_rss()``"""
+    try:
+        with Path("/proc/self/status").open() as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def release_memory():
+    """Garbage collects and hands freed heap memory (e.g. from awkward arrays) back to the OS"""
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
@@ -0,0 +1,113 @@
+"""
+Persistent cache of the coffea preprocessing metadata (number of entries, file UUID) of the input
+files, so that they don't need to be opened just to be preprocessed again by every job.
+"""
+
+from __future__ import annotations
+
+import fcntl
+import json
+import os
+from collections.abc import MutableMapping
+from pathlib import Path
+
+from .runner import get_lfn
+
+# metadata saved for each file, as computed by coffea's preprocessing
+METADATA_KEYS = ["numentries", "uuid", "clusters"]
+
+
+def file_key(filename: str, treename: str) -> str:
+    """
+    Cache key of the tree in ``filename``: remote files are keyed by their logical file name, which
+    is never modified in CMS storage (and so shared between replicas); local files by their path,
+    size and modification time.
+    """
+    if "://" in filename:
+        return f"{get_lfn(filename)}:{treename}"
+
+    stat = Path(filename).stat()
+    return f"{Path(filename).resolve()}@{stat.st_size}-{stat.st_mtime_ns}:{treename}"
+
+
+class MetadataCache(MutableMapping):
+    """
+    ``coffea.processor.Runner.metadata_cache`` backed by the JSON file ``path``.
+
+    Keys are coffea ``FileMeta`` objects, i.e. files and tree names, and values the preprocessing
+    metadata. New entries are written to the file on ``save()``, merged with any entries saved
+    in the meantime by other processes.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._cache = self._load()
+        self._new = {}
+
+    def _load(self) -> dict:
+        if not self.path.exists():
+            return {}
+
+        with self.path.open() as f:
+            return json.load(f)
+
+    def _key(self, filemeta) -> str:
+        return file_key(filemeta.filename, filemeta.treename)
+
+    def __getitem__(self, filemeta):
+        try:
+            metadata = dict(self._cache[self._key(filemeta)])
+        except OSError as e:
+            # local file which doesn't exist (anymore)
+            raise KeyError(filemeta) from e
+
+        metadata["uuid"] = bytes.fromhex(metadata["uuid"])
+        return metadata
+
+    def __setitem__(self, filemeta, metadata: dict):
+        metadata = {key: metadata[key] for key in METADATA_KEYS if key in metadata}
+        metadata["uuid"] = metadata["uuid"].hex()
+        self._cache[self._key(filemeta)] = metadata
+        self._new[self._key(filemeta)] = metadata
+
+    def __delitem__(self, filemeta):
+        del self._cache[self._key(filemeta)]
+        self._new.pop(self._key(filemeta), None)
+
+    def __contains__(self, filemeta) -> bool:
+        try:
+            return self._key(filemeta) in self._cache
+        except OSError:
+            return False
+
+    def __iter__(self):
+        return iter(self._cache)
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def numentries(self, filename: str, treename: str = "Events") -> int | None:
+        """Number of entries of ``filename`` if cached"""
+        try:
+            return self._cache.get(file_key(filename, treename), {}).get("numentries")
+        except OSError:
+            return None
+
+    def save(self):
+        """Writes the new entries to ``path``"""
+        if not self._new:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.with_suffix(".lock").open("a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            cache = {**self._load(), **self._new}
+            # write to a temporary file first so the cache is never partially written
+            tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+            with tmp_path.open("w") as f:
+                json.dump(cache, f)
+            tmp_path.replace(self.path)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self._cache = cache
+        self._new = {}
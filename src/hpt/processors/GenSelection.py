@@ -11,7 +11,8 @@ import numpy as np
 from coffea.nanoevents.methods.base import NanoEventsArray
 from coffea.nanoevents.methods.nanoaod import FatJetArray, JetArray
 
-from .utils import add_selection, pad_val
+from .matching import DeltaRTables
+from .utils import add_selection, pad_fields
 
 d_PDGID = 1
 u_PDGID = 2
@@ -65,16 +66,16 @@ def gen_selection_HHbbbb(
 
     # children 4-vector
     bs = ak.flatten(higgs_children[is_bb], axis=2)
-    GenbVars = {f"Genb{key}": pad_val(bs[var], 4, axis=1) for (var, key) in skim_vars.items()}
+    padded_bs = pad_fields(bs, list(skim_vars), 4)
+    GenbVars = {f"Genb{key}": padded_bs[var] for (var, key) in skim_vars.items()}
 
-    bs_unflat = higgs_children[is_bb]
-    b_h1 = higgs_children[is_bb][:, 0]
-    b_h2 = higgs_children[is_bb][:, 1]
+    # each jet x parton ΔR table is computed once, b quarks are also grouped by Higgs
+    dr = DeltaRTables()
+    bs_per_higgs = ak.num(higgs_children[is_bb], axis=2)
 
     # match jets to each b-quark
-    matched_to_bs = jets.metric_table(bs_unflat) < 0.4
+    matched_to_bs = dr.grouped(jets, bs, bs_per_higgs) < 0.4
     num_b_matched = ak.sum(matched_to_bs, axis=2)
-    matched_to_higgs = jets.metric_table(higgs) < 0.5
 
     # require 1 b matched to the jet (but not necessarily matched to the Higgs)
     is_matched = num_b_matched == 1
@@ -86,44 +87,45 @@ def gen_selection_HHbbbb(
     # we take np.floor of the number divided by 2 to get the index of the higgs
     #  e.g. if it is matched to b quarks 0 or 1 => HiggsMatchIndex = 0
     #  e.g. if it is matched to b quarks 2 or 3 => HiggsMatchIndex = 1
-    jets["HiggsMatchIndex"] = ak.mask(
-        np.floor(ak.argmin(jets.metric_table(bs), axis=2) / 2), jets["HiggsMatch"] == 1
-    )
+    jets["HiggsMatchIndex"] = ak.mask(np.floor(dr.nearest(jets, bs) / 2), jets["HiggsMatch"] == 1)
 
     num_jets = 6
     ak4JetVars = {
-        f"ak4Jet{var}": pad_val(jets[var], num_jets, axis=1)
-        for var in ["HiggsMatch", "HiggsMatchIndex", "hadronFlavour"]
+        f"ak4Jet{var}": padded
+        for var, padded in pad_fields(
+            jets, ["HiggsMatch", "HiggsMatchIndex", "hadronFlavour"], num_jets
+        ).items()
     }
 
-    # match fatjets to bb
-    num_b_matched = ak.sum(fatjets.metric_table(bs_unflat) < 0.8, axis=2)
-    matched_to_higgs = fatjets.metric_table(higgs) < 0.8
-
-    # require 2 bs matched to the jet
-    is_matched = matched_to_higgs
-    is_fatjet_matched = ak.any(is_matched, axis=2)
+    # match fatjets to the higgs
+    is_fatjet_matched = dr.any_within(fatjets, higgs, 0.8)
 
     fatjets["HiggsMatch"] = is_fatjet_matched
-    fatjets["HiggsMatchIndex"] = ak.mask(
-        ak.argmin(fatjets.metric_table(higgs), axis=2), fatjets["HiggsMatch"] == 1
-    )
-    fatjets["NumBMatchedH1"] = ak.sum(fatjets.metric_table(b_h1) < 0.8, axis=2)
-    fatjets["NumBMatchedH2"] = ak.sum(fatjets.metric_table(b_h2) < 0.8, axis=2)
-    fatjets["MaxdRH1"] = ak.max(fatjets.metric_table(b_h1), axis=2)
-    fatjets["MaxdRH2"] = ak.max(fatjets.metric_table(b_h2), axis=2)
+    fatjets["HiggsMatchIndex"] = ak.mask(dr.nearest(fatjets, higgs), fatjets["HiggsMatch"] == 1)
+
+    # ΔR to the b quarks of the first / second higgs
+    dr_bs = dr.grouped(fatjets, bs, bs_per_higgs)
+    dr_b_h1, dr_b_h2 = dr_bs[:, :, 0], dr_bs[:, :, 1]
+    fatjets["NumBMatchedH1"] = ak.sum(dr_b_h1 < 0.8, axis=2)
+    fatjets["NumBMatchedH2"] = ak.sum(dr_b_h2 < 0.8, axis=2)
+    fatjets["MaxdRH1"] = ak.max(dr_b_h1, axis=2)
+    fatjets["MaxdRH2"] = ak.max(dr_b_h2, axis=2)
 
     num_fatjets = 2
     bbFatJetVars = {
-        f"bbFatJet{var}": pad_val(fatjets[var], num_fatjets, axis=1)
-        for var in [
-            "HiggsMatch",
-            "HiggsMatchIndex",
-            "NumBMatchedH1",
-            "NumBMatchedH2",
-            "MaxdRH1",
-            "MaxdRH2",
-        ]
+        f"bbFatJet{var}": padded
+        for var, padded in pad_fields(
+            fatjets,
+            [
+                "HiggsMatch",
+                "HiggsMatchIndex",
+                "NumBMatchedH1",
+                "NumBMatchedH2",
+                "MaxdRH1",
+                "MaxdRH2",
+            ],
+            num_fatjets,
+        ).items()
     }
 
     return {**GenHiggsVars, **GenbVars, **ak4JetVars, **bbFatJetVars}
@@ -149,32 +151,30 @@ def gen_selection_Hbb(
 
     is_bb = abs(higgs_children.pdgId) == b_PDGID
     bs = ak.flatten(higgs_children[is_bb], axis=2)
-    GenbVars = {f"Genb{key}": pad_val(bs[var], 4, axis=1) for (var, key) in skim_vars.items()}
+    padded_bs = pad_fields(bs, list(skim_vars), 4)
+    GenbVars = {f"Genb{key}": padded_bs[var] for (var, key) in skim_vars.items()}
 
     # match fatjets to bb
-    # bs_unflat = higgs_children[is_bb]
-    # num_b_matched = ak.sum(fatjets.metric_table(bs_unflat) < 0.8, axis=2)
-    b_h1 = ak.firsts(higgs_children[is_bb][:, 0:1])
-    b_h2 = ak.firsts(higgs_children[is_bb][:, 1:2])
-    matched_to_higgs = fatjets.metric_table(higgs) < 0.8
-    is_fatjet_matched = ak.any(matched_to_higgs, axis=2)
+    dr = DeltaRTables()
+    dr_bs = dr.grouped(fatjets, bs, ak.num(higgs_children[is_bb], axis=2))
+    # ΔR to the b quarks of the first / second higgs, if any
+    dr_b_h1 = ak.firsts(dr_bs[:, :, 0:1], axis=2)
+    dr_b_h2 = ak.firsts(dr_bs[:, :, 1:2], axis=2)
+    is_fatjet_matched = dr.any_within(fatjets, higgs, 0.8)
 
     fatjets["HiggsMatch"] = is_fatjet_matched
-    fatjets["HiggsMatchIndex"] = ak.mask(
-        ak.argmin(fatjets.metric_table(higgs), axis=2), fatjets["HiggsMatch"] == 1
-    )
-    fatjets["NumBMatchedH1"] = ak.sum(fatjets.metric_table(b_h1) < 0.8, axis=2)
-    fatjets["NumBMatchedH2"] = ak.sum(fatjets.metric_table(b_h2) < 0.8, axis=2)
+    fatjets["HiggsMatchIndex"] = ak.mask(dr.nearest(fatjets, higgs), fatjets["HiggsMatch"] == 1)
+    fatjets["NumBMatchedH1"] = ak.sum(dr_b_h1 < 0.8, axis=2)
+    fatjets["NumBMatchedH2"] = ak.sum(dr_b_h2 < 0.8, axis=2)
 
     num_fatjets = 2
     bbFatJetVars = {
-        f"bbFatJet{var}": pad_val(fatjets[var], num_fatjets, axis=1)
-        for var in [
-            "HiggsMatch",
-            "HiggsMatchIndex",
-            "NumBMatchedH1",
-            "NumBMatchedH2",
-        ]
+        f"bbFatJet{var}": padded
+        for var, padded in pad_fields(
+            fatjets,
+            ["HiggsMatch", "HiggsMatchIndex", "NumBMatchedH1", "NumBMatchedH2"],
+            num_fatjets,
+        ).items()
     }
 
     return {**GenHiggsVars, **GenbVars, **bbFatJetVars}
@@ -194,17 +194,29 @@ def gen_selection_V(
     ]
     GenVVars = {f"GenV{key}": vs[var].to_numpy() for (var, key) in skim_vars.items()}
 
-    matched_to_v = fatjets.metric_table(vs) < 0.8
-    is_fatjet_matched = ak.any(matched_to_v, axis=2)
+    is_fatjet_matched = DeltaRTables().any_within(fatjets, vs, 0.8)
 
     fatjets["VMatch"] = is_fatjet_matched
 
     num_fatjets = 2
     bbFatJetVars = {
-        f"bbFatJet{var}": pad_val(fatjets[var], num_fatjets, axis=1)
-        for var in [
-            "VMatch",
-        ]
+        f"bbFatJet{var}": padded
+        for var, padded in pad_fields(fatjets, ["VMatch"], num_fatjets).items()
     }
 
     return {**GenVVars, **bbFatJetVars}
+
+
+_GENPART_COLUMNS = ["GenPart_pdgId", "GenPart_statusFlags", "GenPart_genPartIdxMother"]
+_DR_COLUMNS = ["eta", "phi"]
+
+# NanoAOD branches read by each gen selection function, besides the ``skim_vars`` of GenPart
+GEN_SELECTION_COLUMNS = {
+    gen_selection_HHbbbb: [
+        *_GENPART_COLUMNS,
+        *[f"Jet_{var}" for var in [*_DR_COLUMNS, "hadronFlavour"]],
+        *[f"FatJet_{var}" for var in _DR_COLUMNS],
+    ],
+    gen_selection_Hbb: [*_GENPART_COLUMNS, *[f"FatJet_{var}" for var in _DR_COLUMNS]],
+    gen_selection_V: [*_GENPART_COLUMNS, *[f"FatJet_{var}" for var in _DR_COLUMNS]],
+}
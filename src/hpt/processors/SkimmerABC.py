@@ -43,9 +43,30 @@ class SkimmerABC(processor.ProcessorABC):
             keys=list(events.keys()),
         )
 
-    def dump_table(self, pddf: pd.DataFrame, fname: str, odir_str: str = None) -> None:
+    def to_arrow(self, events: dict[str, np.array]):
         """
-        Saves pandas dataframe events to './outparquet'
+        Convert our dictionary of numpy arrays directly into a pyarrow record batch,
+        without going through pandas. Numeric arrays are wrapped without copying;
+        arrays with >1 column (e.g. FatJet arrays with two columns) become fixed size list columns.
+        """
+        import pyarrow as pa
+
+        columns = []
+        for v in events.values():
+            arr = np.ascontiguousarray(v.reshape(len(v), -1))
+            column = pa.array(arr.reshape(-1))
+            if arr.shape[1] > 1:
+                column = pa.FixedSizeListArray.from_arrays(column, arr.shape[1])
+            columns.append(column)
+
+        return pa.RecordBatch.from_arrays(columns, names=list(events.keys()))
+
+    def dump_table(
+        self, table, fname: str, odir_str: str = None, metadata: dict[str, str] = None
+    ) -> None:
+        """
+        Saves events (a pandas dataframe or pyarrow record batch / table) to './outparquet',
+        adding ``metadata`` to the schema metadata of the file
         """
         import pyarrow as pa
         import pyarrow.parquet as pq
@@ -55,10 +76,21 @@ class SkimmerABC(processor.ProcessorABC):
             local_dir += odir_str
         local_dir.mkdir(parents=True, exist_ok=True)
 
-        # need to write with pyarrow as pd.to_parquet doesn't support different types in
-        # multi-index column names
-        table = pa.Table.from_pandas(pddf)
-        pq.write_table(table, local_dir / fname)
+        if isinstance(table, pd.DataFrame):
+            # need to write with pyarrow as pd.to_parquet doesn't support different types in
+            # multi-index column names
+            table = pa.Table.from_pandas(table)
+        elif isinstance(table, pa.RecordBatch):
+            table = pa.Table.from_batches([table])
+
+        if metadata:
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}), **metadata})
+
+        # write to a temporary file first, so that files in the directory are always complete
+        # (the output is read while processing for the ROOT ntuples)
+        tmp_fname = local_dir / f"{fname}.tmp"
+        pq.write_table(table, tmp_fname)
+        tmp_fname.replace(local_dir / fname)
 
 
     def get_dataset_norm(self, year, dataset):
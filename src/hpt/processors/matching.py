@@ -0,0 +1,155 @@
+"""
+ΔR tables between collections (e.g. jets and gen partons), computed once per chunk and shared by
+the matching variables derived from them, and ΔR overlap removal without building the tables.
+"""
+
+from __future__ import annotations
+
+import awkward as ak
+import numba
+import numpy as np
+
+
+@numba.vectorize(
+    [
+        numba.float32(numba.float32, numba.float32),
+        numba.float64(numba.float64, numba.float64),
+    ]
+)
+def _delta_phi(a, b):
+    # same kernel as coffea's ``delta_phi``, so that ΔR values are identical to ``metric_table``
+    return (a - b + np.pi) % (2 * np.pi) - np.pi
+
+
+def _pair_index(n_outer: np.ndarray, n_inner: np.ndarray, outer_event: np.ndarray):
+    """
+    Flat (outer, inner) indices of all pairs of the elements of a jagged array with ``n_outer``
+    elements per event (in event ``outer_event``) and one with ``n_inner`` elements per event,
+    ordered by outer element, and the number of pairs per outer element.
+    """
+    inner_starts = np.cumsum(n_inner) - n_inner
+    npairs = n_inner[outer_event]
+    pair_starts = np.cumsum(npairs) - npairs
+    outer = np.repeat(np.arange(len(outer_event)), npairs)
+    inner = np.repeat(inner_starts[outer_event] - pair_starts, npairs) + np.arange(npairs.sum())
+    return outer, inner, npairs
+
+
+def delta_r_table(a: ak.Array, b: ak.Array) -> ak.Array:
+    """
+    ΔR between each element of the jagged arrays ``a`` and ``b`` in each event, as an
+    (event, a, b) array: the same as ``a.metric_table(b)``, computed on the flat eta / phi arrays
+    """
+    na = ak.num(a, axis=1).to_numpy()
+    nb = ak.num(b, axis=1).to_numpy()
+    index_a, index_b, npairs = _pair_index(na, nb, np.repeat(np.arange(len(na)), na))
+
+    eta_a, phi_a = (ak.flatten(a[var], axis=1).to_numpy() for var in ["eta", "phi"])
+    eta_b, phi_b = (ak.flatten(b[var], axis=1).to_numpy() for var in ["eta", "phi"])
+    dr = np.hypot(eta_a[index_a] - eta_b[index_b], _delta_phi(phi_a[index_a], phi_b[index_b]))
+    return ak.unflatten(ak.unflatten(dr, npairs), na)
+
+
+class DeltaRTables:
+    """
+    Computes each ΔR table between two collections once and caches it (e.g. for one chunk), and
+    derives the matching variables from the cached tables. Collections are identified by object,
+    so the same arrays need to be passed each time.
+
+    e.g. ``dr.any_within(fatjets, higgs, 0.8)`` and ``dr.nearest(fatjets, higgs)`` share one table.
+    """
+
+    def __init__(self):
+        # the arrays are kept with their table so that their ids aren't reused
+        self._tables = {}
+
+    def __call__(self, a: ak.Array, b: ak.Array) -> ak.Array:
+        """ΔR table of ``a`` and ``b`` (see ``delta_r_table``)"""
+        key = (id(a), id(b))
+        if key not in self._tables:
+            self._tables[key] = (a, b, delta_r_table(a, b))
+        return self._tables[key][2]
+
+    def grouped(self, a: ak.Array, b: ak.Array, groups: ak.Array) -> ak.Array:
+        """
+        ΔR table of ``a`` and ``b``, with the elements of ``b`` split into groups of ``groups``
+        (number per group in each event) as an (event, a, group, b) array, e.g. b quarks by
+        parent Higgs: the same as ``a.metric_table(b_per_group)`` for ``b_per_group`` the
+        (event, group, b) array, e.g. ``higgs.children``
+        """
+        key = (id(a), id(b), id(groups))
+        if key not in self._tables:
+            table = self(a, b)
+            na = ak.num(a, axis=1).to_numpy()
+            ngroups = ak.num(groups, axis=1).to_numpy()
+            # number of b per (event, a, group), and of groups per (event, a)
+            _, index_group, npairs = _pair_index(na, ngroups, np.repeat(np.arange(len(na)), na))
+            group_sizes = ak.flatten(groups, axis=1).to_numpy()[index_group]
+            # only unflattened along the first axis, as awkward 1's ``unflatten`` along the
+            # others misplaces empty groups at the boundaries of the events
+            flat = ak.flatten(table, axis=None)
+            grouped = ak.unflatten(ak.unflatten(ak.unflatten(flat, group_sizes), npairs), na)
+            self._tables[key] = (a, b, groups, grouped)
+        return self._tables[key][3]
+
+    def any_within(self, a: ak.Array, b: ak.Array, dr: float) -> ak.Array:
+        """Whether each element of ``a`` is within ``dr`` of any element of ``b``"""
+        return ak.any(self(a, b) < dr, axis=2)
+
+    def count_within(self, a: ak.Array, b: ak.Array, dr: float) -> ak.Array:
+        """Number of elements of ``b`` within ``dr`` of each element of ``a``"""
+        return ak.sum(self(a, b) < dr, axis=2)
+
+    def nearest(self, a: ak.Array, b: ak.Array) -> ak.Array:
+        """Index of the element of ``b`` closest to each element of ``a``"""
+        return ak.argmin(self(a, b), axis=2)
+
+    def max(self, a: ak.Array, b: ak.Array) -> ak.Array:
+        """Largest ΔR between each element of ``a`` and the elements of ``b``"""
+        return ak.max(self(a, b), axis=2)
+
+
+@numba.njit
+def _no_overlap_kernel(offsets, eta, phi, veto_offsets, veto_eta, veto_phi, drs, keep):
+    for event in range(len(offsets) - 1):
+        for i in range(offsets[event], offsets[event + 1]):
+            for veto in range(len(drs)):
+                for j in range(veto_offsets[veto, event], veto_offsets[veto, event + 1]):
+                    dr = np.hypot(eta[i] - veto_eta[j], _delta_phi(phi[i], veto_phi[j]))
+                    # not ``dr <= drs[veto]``, so that NaNs overlap as in ``ak.all(dr > ...)``
+                    if not dr > drs[veto]:
+                        keep[i] = False
+                        break
+                if not keep[i]:
+                    break
+
+
+def no_overlap(a: ak.Array, vetoes: list[tuple[ak.Array, float]]) -> ak.Array:
+    """
+    Whether each element of ``a`` is further than ``dr`` from all the elements of each veto
+    collection, for the (collection, dr) pairs in ``vetoes`` (e.g. jets vs. fatjets and leptons):
+    the same as ``ak.all(a.metric_table(collection) > dr, axis=2)`` for each collection, and-ed,
+    in one pass over the events without building the ΔR tables
+    """
+    counts = ak.num(a, axis=1).to_numpy()
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    eta, phi = (ak.flatten(a[var], axis=1).to_numpy() for var in ["eta", "phi"])
+
+    # the veto collections one after the other, with the offsets of each into the flat arrays
+    veto_offsets = np.zeros((len(vetoes), len(counts) + 1), dtype=np.int64)
+    start = 0
+    for i, (collection, _) in enumerate(vetoes):
+        veto_offsets[i, 1:] = start + np.cumsum(ak.num(collection, axis=1).to_numpy())
+        veto_offsets[i, 0] = start
+        start = veto_offsets[i, -1]
+
+    veto_eta, veto_phi = (
+        np.concatenate([ak.flatten(c[var], axis=1).to_numpy() for c, _ in vetoes])
+        for var in ["eta", "phi"]
+    )
+    # thresholds in the dtype of the ΔR values, as in the comparison of the ΔR table to a float
+    drs = np.array([dr for _, dr in vetoes], dtype=np.result_type(eta, veto_eta))
+
+    keep = np.ones(len(eta), dtype=bool)
+    _no_overlap_kernel(offsets, eta, phi, veto_offsets, veto_eta, veto_phi, drs, keep)
+    return ak.unflatten(keep, counts)
@@ -10,6 +10,9 @@ from coffea.nanoevents.methods.nanoaod import (
     TauArray,
 )
 
+from .matching import _delta_phi, no_overlap
+from .utils import top_k
+
 # https://twiki.cern.ch/twiki/bin/view/CMS/MuonRun32022
 
 
@@ -137,19 +140,89 @@ def bregcorr(jets: JetArray):
     )
 
 
-# add extra variables to FatJet collection
-def get_ak8jets(fatjets: FatJetArray):
-    fatjets["t32"] = ak.nan_to_num(fatjets.tau3 / fatjets.tau2, nan=-1.0)
-    fatjets["t21"] = ak.nan_to_num(fatjets.tau2 / fatjets.tau1, nan=-1.0)
+_PNET_MD = [f"particleNetMD_{x}" for x in ["Xbb", "Xcc", "Xqq", "QCD"]]
+_PNET_MD_PROB = [
+    f"ParticleNetMD_prob{x}" for x in ["Xbb", "Xcc", "Xqq", "QCDb", "QCDbb", "QCDc", "QCDcc"]
+] + ["ParticleNetMD_probQCDothers"]
+_PNET_LEGACY = [
+    f"particleNetLegacy_{x}" for x in ["Xbb", "Xqq", "QCD", "QCDb", "QCDbb", "QCDothers"]
+]
+_PNET_MASS = ["mass", "particleNet_mass", "particleNet_massCorr", "rawFactor"]
 
-    fatjets_fields = fatjets.fields
+# derived FatJet fields which ``get_ak8jets`` can add: name -> function computing the field from
+# (fatjets, names of the FatJet branches in the file, ``derived`` getter of other derived fields),
+# returning None if the field can't be computed with this NanoAOD version
+AK8_DERIVED_FIELDS = {}
+
+# FatJet branches which may be read for each derived field (including those of the fields it
+# depends on), with the alternatives for the different NanoAOD versions (only those in the file
+# are read)
+AK8_DERIVED_INPUTS = {}
+
+
+def _ak8_derived(name: str, inputs: list[str]):
+    """Registers the function computing the derived FatJet field ``name`` from ``inputs``"""
+
+    def register(func):
+        AK8_DERIVED_FIELDS[name] = func
+        AK8_DERIVED_INPUTS[name] = inputs
+        return func
+
+    return register
+
+
+@_ak8_derived("t32", ["tau3", "tau2"])
+def _t32(fatjets, branches, derived):  # noqa: ARG001
+    return ak.nan_to_num(fatjets.tau3 / fatjets.tau2, nan=-1.0)
+
+
+@_ak8_derived("t21", ["tau2", "tau1"])
+def _t21(fatjets, branches, derived):  # noqa: ARG001
+    return ak.nan_to_num(fatjets.tau2 / fatjets.tau1, nan=-1.0)
+
+
+@_ak8_derived("Tqcd", [*_PNET_MD, *_PNET_MD_PROB, "particleNet_QCD"])
+def _tqcd(fatjets, branches, derived):  # noqa: ARG001
+    if "particleNetMD_Xbb" in branches:
+        return fatjets.particleNetMD_QCD
+    if "ParticleNetMD_probXbb" in branches:
+        return (
+            fatjets.ParticleNetMD_probQCDb
+            + fatjets.ParticleNetMD_probQCDbb
+            + fatjets.ParticleNetMD_probQCDc
+            + fatjets.ParticleNetMD_probQCDcc
+            + fatjets.ParticleNetMD_probQCDothers
+        )
+    return fatjets.particleNet_QCD
 
-    if "particleNetMD_Xbb" in fatjets_fields:
-        fatjets["Txbb"] = ak.nan_to_num(
+
+@_ak8_derived("Txbb", [*_PNET_MD, *_PNET_MD_PROB, "particleNet_XbbVsQCD"])
+def _txbb(fatjets, branches, derived):
+    if "particleNetMD_Xbb" in branches:
+        return ak.nan_to_num(
             fatjets.particleNetMD_Xbb / (fatjets.particleNetMD_QCD + fatjets.particleNetMD_Xbb),
             nan=-1.0,
         )
-        fatjets["Txjj"] = ak.nan_to_num(
+    if "ParticleNetMD_probXbb" in branches:
+        return fatjets.ParticleNetMD_probXbb / (fatjets.ParticleNetMD_probXbb + derived("Tqcd"))
+    return fatjets.particleNet_XbbVsQCD
+
+
+@_ak8_derived("Pxjj", _PNET_MD_PROB)
+def _pxjj(fatjets, branches, derived):  # noqa: ARG001
+    if "ParticleNetMD_probXbb" not in branches or "particleNetMD_Xbb" in branches:
+        return None
+    return (
+        fatjets.ParticleNetMD_probXbb
+        + fatjets.ParticleNetMD_probXcc
+        + fatjets.ParticleNetMD_probXqq
+    )
+
+
+@_ak8_derived("Txjj", [*_PNET_MD, *_PNET_MD_PROB, "particleNet_XqqVsQCD"])
+def _txjj(fatjets, branches, derived):
+    if "particleNetMD_Xbb" in branches:
+        return ak.nan_to_num(
             (fatjets.particleNetMD_Xbb + fatjets.particleNetMD_Xcc + fatjets.particleNetMD_Xqq)
             / (
                 fatjets.particleNetMD_Xbb
@@ -159,82 +232,123 @@ def get_ak8jets(fatjets: FatJetArray):
             ),
             nan=-1.0,
         )
-        fatjets["Tqcd"] = fatjets.particleNetMD_QCD
-    elif "ParticleNetMD_probXbb" in fatjets_fields:
-        fatjets["Tqcd"] = (
-            fatjets.ParticleNetMD_probQCDb
-            + fatjets.ParticleNetMD_probQCDbb
-            + fatjets.ParticleNetMD_probQCDc
-            + fatjets.ParticleNetMD_probQCDcc
-            + fatjets.ParticleNetMD_probQCDothers
-        )
-        fatjets["Txbb"] = fatjets.ParticleNetMD_probXbb / (
-            fatjets.ParticleNetMD_probXbb + fatjets["Tqcd"]
-        )
-        fatjets["Pxjj"] = (
-            fatjets.ParticleNetMD_probXbb
-            + fatjets.ParticleNetMD_probXcc
-            + fatjets.ParticleNetMD_probXqq
-        )
-        fatjets["Txjj"] = fatjets["Pxjj"] / (fatjets["Pxjj"] + fatjets["Tqcd"])
-    else:
-        fatjets["Txbb"] = fatjets.particleNet_XbbVsQCD
-        fatjets["Txjj"] = fatjets.particleNet_XqqVsQCD
-        fatjets["Tqcd"] = fatjets.particleNet_QCD
+    if "ParticleNetMD_probXbb" in branches:
+        return derived("Pxjj") / (derived("Pxjj") + derived("Tqcd"))
+    return fatjets.particleNet_XqqVsQCD
+
+
+@_ak8_derived("particleNet_mass", _PNET_MASS)
+def _particlenet_mass(fatjets, branches, derived):  # noqa: ARG001
+    if "particleNet_massCorr" in branches:
+        return fatjets.mass * fatjets.particleNet_massCorr
+    if "particleNet_mass" in branches:
+        return fatjets.particleNet_mass
+    return fatjets.mass
+
+
+@_ak8_derived("particleNet_massraw", _PNET_MASS)
+def _particlenet_massraw(fatjets, branches, derived):  # noqa: ARG001
+    if "particleNet_massCorr" in branches:
+        return (1 - fatjets.rawFactor) * fatjets.mass * fatjets.particleNet_massCorr
+    if "particleNet_mass" in branches:
+        return fatjets.particleNet_mass
+    return fatjets.mass
+
+
+def _pqcd(name: str, prob_branch: str, pnet_branch: str):
+    @_ak8_derived(name, [*_PNET_MD, *_PNET_MD_PROB, pnet_branch])
+    def pqcd(fatjets, branches, derived):  # noqa: ARG001
+        if "ParticleNetMD_probQCDb" in branches:
+            return fatjets[prob_branch]
+        if "particleNet_QCD1HF" in branches:
+            return fatjets[pnet_branch]
+        # dummy
+        return fatjets.particleNetMD_QCD
 
-    if "particleNet_mass" not in fatjets_fields:
-        fatjets["particleNet_mass"] = fatjets.mass
 
-    if "particleNet_massCorr" in fatjets_fields:
-        fatjets["particleNet_mass"] = fatjets.mass * fatjets.particleNet_massCorr
-        fatjets["particleNet_massraw"] = (
-            (1 - fatjets.rawFactor) * fatjets.mass * fatjets.particleNet_massCorr
-        )
-    else:
-        if "particleNet_mass" not in fatjets_fields:
-            fatjets["particleNet_mass"] = fatjets.mass
-            fatjets["particleNet_massraw"] = fatjets.mass
-        else:
-            fatjets["particleNet_massraw"] = fatjets.particleNet_mass
-
-    if "ParticleNetMD_probQCDb" in fatjets_fields:
-        fatjets["PQCDb"] = fatjets.ParticleNetMD_probQCDb
-        fatjets["PQCDbb"] = fatjets.ParticleNetMD_probQCDbb
-        fatjets["PQCDothers"] = fatjets.ParticleNetMD_probQCDothers
-    elif "particleNet_QCD1HF" in fatjets_fields:
-        fatjets["PQCDb"] = fatjets.particleNet_QCD1HF
-        fatjets["PQCDbb"] = fatjets.particleNet_QCD2HF
-        fatjets["PQCDothers"] = fatjets.particleNet_QCD0HF
-    else:
-        # dummy
-        fatjets["PQCDb"] = fatjets.particleNetMD_QCD
-        fatjets["PQCDbb"] = fatjets.particleNetMD_QCD
-        fatjets["PQCDothers"] = fatjets.particleNetMD_QCD
+_pqcd("PQCDb", "ParticleNetMD_probQCDb", "particleNet_QCD1HF")
+_pqcd("PQCDbb", "ParticleNetMD_probQCDbb", "particleNet_QCD2HF")
+_pqcd("PQCDothers", "ParticleNetMD_probQCDothers", "particleNet_QCD0HF")
 
-    if "particleNetLegacy_Xbb" in fatjets_fields:
-        fatjets["TXbb_legacy"] = fatjets.particleNetLegacy_Xbb / (
+
+@_ak8_derived("TXbb_legacy", [*_PNET_LEGACY, *AK8_DERIVED_INPUTS["Txbb"]])
+def _txbb_legacy(fatjets, branches, derived):
+    if "particleNetLegacy_Xbb" in branches:
+        return fatjets.particleNetLegacy_Xbb / (
             fatjets.particleNetLegacy_Xbb + fatjets.particleNetLegacy_QCD
         )
-        fatjets["TXqq_legacy"] = fatjets.particleNetLegacy_Xqq / (
-            fatjets.particleNetLegacy_Xqq + fatjets.particleNetLegacy_QCD
-        )
-        fatjets["PXbb_legacy"] = fatjets.particleNetLegacy_Xbb
-        fatjets["PQCD_legacy"] = fatjets.particleNetLegacy_QCD
-        fatjets["PQCDb_legacy"] = fatjets.particleNetLegacy_QCDb
-        fatjets["PQCDbb_legacy"] = fatjets.particleNetLegacy_QCDbb
-        fatjets["PQCDothers_legacy"] = fatjets.particleNetLegacy_QCDothers
-    else:
-        fatjets["TXbb_legacy"] = fatjets["Txbb"]
+    return derived("Txbb")
 
-    if "particleNetLegacy_mass" in fatjets_fields:
-        fatjets["particleNet_mass_legacy"] = fatjets.particleNetLegacy_mass
-    else:
-        fatjets["particleNet_mass_legacy"] = fatjets["particleNet_mass"]
 
-    if "particleNetWithMass_TvsQCD" in fatjets_fields:
-        fatjets["particleNetWithMass_TvsQCD"] = fatjets.particleNetWithMass_TvsQCD
+@_ak8_derived("TXqq_legacy", _PNET_LEGACY)
+def _txqq_legacy(fatjets, branches, derived):  # noqa: ARG001
+    if "particleNetLegacy_Xbb" not in branches:
+        return None
+    return fatjets.particleNetLegacy_Xqq / (
+        fatjets.particleNetLegacy_Xqq + fatjets.particleNetLegacy_QCD
+    )
+
+
+def _legacy(name: str, branch: str):
+    @_ak8_derived(name, _PNET_LEGACY)
+    def legacy(fatjets, branches, derived):  # noqa: ARG001
+        return fatjets[branch] if "particleNetLegacy_Xbb" in branches else None
+
+
+_legacy("PXbb_legacy", "particleNetLegacy_Xbb")
+_legacy("PQCD_legacy", "particleNetLegacy_QCD")
+_legacy("PQCDb_legacy", "particleNetLegacy_QCDb")
+_legacy("PQCDbb_legacy", "particleNetLegacy_QCDbb")
+_legacy("PQCDothers_legacy", "particleNetLegacy_QCDothers")
+
 
-    fatjets["pt_raw"] = (1 - fatjets.rawFactor) * fatjets.pt
+@_ak8_derived("particleNet_mass_legacy", ["particleNetLegacy_mass", *_PNET_MASS])
+def _particlenet_mass_legacy(fatjets, branches, derived):
+    if "particleNetLegacy_mass" in branches:
+        return fatjets.particleNetLegacy_mass
+    return derived("particleNet_mass")
+
+
+@_ak8_derived("particleNetWithMass_TvsQCD", ["particleNetWithMass_TvsQCD"])
+def _particlenet_withmass_tvsqcd(fatjets, branches, derived):  # noqa: ARG001
+    if "particleNetWithMass_TvsQCD" not in branches:
+        return None
+    return fatjets.particleNetWithMass_TvsQCD
+
+
+@_ak8_derived("pt_raw", ["rawFactor", "pt"])
+def _pt_raw(fatjets, branches, derived):  # noqa: ARG001
+    return (1 - fatjets.rawFactor) * fatjets.pt
+
+
+def ak8jets_columns(fields: list[str]) -> set[str]:
+    """NanoAOD branches needed for the ``fields`` of the ``get_ak8jets(fatjets, fields)`` FatJets"""
+    columns = set()
+    for field in fields:
+        columns |= {f"FatJet_{branch}" for branch in AK8_DERIVED_INPUTS.get(field, [field])}
+    return columns
+
+
+# add extra variables to FatJet collection
+def get_ak8jets(fatjets: FatJetArray, fields: list[str] | None = None):
+    """
+    Adds the derived ``fields`` (by default all of ``AK8_DERIVED_FIELDS``; other fields are
+    ignored) to the FatJet collection. Only these and the derived fields they depend on are
+    computed, so only their input branches are read.
+    """
+    branches = fatjets.fields
+    computed = {}
+
+    def derived(name: str):
+        if name not in computed:
+            computed[name] = AK8_DERIVED_FIELDS[name](fatjets, branches, derived)
+            if computed[name] is not None:
+                fatjets[name] = computed[name]
+        return computed[name]
+
+    for name in AK8_DERIVED_FIELDS if fields is None else fields:
+        if name in AK8_DERIVED_FIELDS:
+            derived(name)
 
     return fatjets
 
@@ -277,14 +391,24 @@ def vbf_jets(
         jets.isTight
         & (jets.pt >= pt)
         & (np.abs(jets.eta) <= eta_max)
-        & (ak.all(jets.metric_table(fatjets) > dr_fatjets, axis=2))
-        & ak.all(jets.metric_table(electrons) > dr_leptons, axis=2)
-        & ak.all(jets.metric_table(muons) > dr_leptons, axis=2)
+        & no_overlap(jets, [(fatjets, dr_fatjets), (electrons, dr_leptons), (muons, dr_leptons)])
     )
 
     return jets[ak4_sel][:, :2]
 
 
+def _nearest_jet(jets: JetArray, ak4_sel: ak.Array, fatjet: FatJetArray):
+    """
+    The jet passing ``ak4_sel`` closest to ``fatjet`` as a list of up to one jet per event, None
+    in events without ``fatjet``
+    """
+    has_fatjet = ~ak.is_none(fatjet)
+    # ``jets.delta_r(fatjet)``, with one (masked) value per jet in events without ``fatjet`` too
+    eta, phi = (ak.fill_none(fatjet[var], np.float32(0)) for var in ["eta", "phi"])
+    dr = np.hypot(jets.eta - eta, _delta_phi(jets.phi, phi))
+    return ak.mask(jets[top_k(dr, 1, ak4_sel & has_fatjet, ascending=True)], has_fatjet)
+
+
 def ak4_jets_awayfromak8(
     jets: JetArray,
     fatjets: FatJetArray,
@@ -309,26 +433,18 @@ def ak4_jets_awayfromak8(
         jets.isTight
         & (jets.pt >= pt)
         & (np.abs(jets.eta) <= eta_max)
-        & (ak.all(jets.metric_table(fatjets) > dr_fatjets, axis=2))
-        & ak.all(jets.metric_table(electrons) > dr_leptons, axis=2)
-        & ak.all(jets.metric_table(muons) > dr_leptons, axis=2)
+        & no_overlap(jets, [(fatjets, dr_fatjets), (electrons, dr_leptons), (muons, dr_leptons)])
     )
 
     # return top 2 jets sorted by btagPNetB
     if sort_by == "btag":
-        jets_pnetb = jets[ak.argsort(jets.btagPNetB, ascending=False)]
-        return jets_pnetb[ak4_sel][:, :2]
+        return jets[top_k(jets.btagPNetB, 2, ak4_sel)]
     # return 2 jets closet to fatjet0 and fatjet1, respectively
     elif sort_by == "nearest":
-        jets_away = jets[ak4_sel]
         FirstFatjet = ak.firsts(fatjets[:, 0:1])
         SecondFatjet = ak.firsts(fatjets[:, 1:2])
-        jet_near_fatjet0 = jets_away[ak.argsort(jets_away.delta_r(FirstFatjet), ascending=True)][
-            :, 0:1
-        ]
-        jet_near_fatjet1 = jets_away[ak.argsort(jets_away.delta_r(SecondFatjet), ascending=True)][
-            :, 0:1
-        ]
+        jet_near_fatjet0 = _nearest_jet(jets, ak4_sel, FirstFatjet)
+        jet_near_fatjet1 = _nearest_jet(jets, ak4_sel, SecondFatjet)
         return [jet_near_fatjet0, jet_near_fatjet1]
     # return all nonoverlapping jets, no sorting
     else:
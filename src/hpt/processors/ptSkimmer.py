@@ -4,22 +4,39 @@ Skimmer for simple analysis with FatJets.
 
 from __future__ import annotations
 import logging
-import time
+import json
 from collections import OrderedDict
 
 import awkward as ak
 import numpy as np
 from coffea import processor
-from coffea.analysis_tools import PackedSelection, Weights
+from coffea.analysis_tools import Weights
 
 from . import utils
 from hpt import common_vars
-from .GenSelection import gen_selection_V, gen_selection_HHbbbb, gen_selection_Hbb
+from .GenSelection import (
+    GEN_SELECTION_COLUMNS,
+    gen_selection_V,
+    gen_selection_HHbbbb,
+    gen_selection_Hbb,
+)
 from .objects import (
+    ak8jets_columns,
     get_ak8jets,
 )
 from .SkimmerABC import SkimmerABC
-from .utils import P4, add_selection, pad_val
+from .utils import (
+    P4,
+    TRIGGER_BITS_KEY,
+    CutflowSelection,
+    MemoryProfiler,
+    PrunedNanoAODSchema,
+    StageTimer,
+    add_selection,
+    compact_dtypes,
+    pack_bits,
+    pad_fields,
+)
 
 
 # mapping samples to the appropriate function for doing gen-level selections
@@ -60,14 +77,85 @@ class ptSkimmer(SkimmerABC):
         },
     }
 
+    HLTs = [  # noqa: RUF012
+        # offline triggers
+        "QuadPFJet70_50_40_35_PFBTagParticleNet_2BTagSum0p65",
+        "PFHT1050",
+        "AK8PFJet230_SoftDropMass40_PFAK8ParticleNetBB0p35",
+        "AK8PFJet250_SoftDropMass40_PFAK8ParticleNetBB0p35",
+        "AK8PFJet275_SoftDropMass40_PFAK8ParticleNetBB0p35",
+        "AK8PFJet230_SoftDropMass40",
+        "AK8PFJet425_SoftDropMass40",
+        "AK8PFJet400_SoftDropMass40",
+        "AK8DiPFJet250_250_MassSD50",
+        "AK8DiPFJet260_260_MassSD30",
+        "AK8PFJet420_MassSD30",
+        "AK8PFJet230_SoftDropMass40_PNetBB0p06",
+        "AK8PFJet230_SoftDropMass40_PNetBB0p10",
+        "AK8PFJet250_SoftDropMass40_PNetBB0p06",
+        # parking triggers
+        # HHparking
+        "PFHT280_QuadPFJet30_PNet2BTagMean0p55",
+        # VBFparking
+        # https://its.cern.ch/jira/browse/CMSHLT-3058
+        "DiJet110_35_Mjj650_PFMET110",
+        "TripleJet110_35_35_Mjj650_PFMET110",
+        "VBF_DiPFJet80_45_Mjj650_PFMETNoMu85",
+        "VBF_DiPFJet110_35_Mjj650",
+        "VBF_DiPFJet110_35_Mjj650_TriplePFJet",
+        "VBF_DiPFJet110_40_Mjj1000_Detajj3p5",
+        "VBF_DiPFJet110_40_Mjj1000_Detajj3p5_TriplePFJet",
+        "VBF_DiJet_60_30_Mass500_DiJet50",
+        "VBF_DiJet_110_35_Mass620",
+        # SingleMuonparking
+        "Mu12_IP6",
+    ]
+
+    # dtypes of the skimmed variables with ``compact_dtypes`` (other floats are saved as float32):
+    # integers are padded with ``INT_PAD_VAL`` (-1) and flags with False
+    output_dtypes = {  # noqa: RUF012
+        "ak4JetHiggsMatch": bool,
+        "ak4JetHiggsMatchIndex": np.int8,
+        "ak4JethadronFlavour": np.int8,
+        "bbFatJetHiggsMatch": bool,
+        "bbFatJetHiggsMatchIndex": np.int8,
+        "bbFatJetNumBMatchedH1": np.int8,
+        "bbFatJetNumBMatchedH2": np.int8,
+        "bbFatJetVMatch": bool,
+        # pdg id
+        "GenHiggsChildren": np.int32,
+        # summed over many events for the normalization
+        "weight": np.float64,
+        "weight_noxsec": np.float64,
+        **dict.fromkeys(HLTs, bool),
+    }
+
     def __init__(
         self,
         xsecs=None,
+        arrow_output: bool = False,
+        profile_memory: bool = False,
+        pack_triggers: bool = False,
+        compact_dtypes: bool = False,
     ):
         super().__init__()
 
         self.XSECS = xsecs if xsecs is not None else {}  # in pb
 
+        # write the per-chunk tables directly with pyarrow instead of through pandas
+        # (2D arrays are saved as fixed size list columns instead of multi-index columns)
+        self._arrow_output = arrow_output
+
+        # record the peak memory of each stage and the size of the main arrays in the output
+        self._profile_memory = profile_memory
+
+        # save the triggers as bits of a single "HLTBits" integer instead of a column each,
+        # with the trigger -> bit map in the parquet metadata (see ``utils.unpack_bits``)
+        self._pack_triggers = pack_triggers
+
+        # save the skimmed variables with the compact ``output_dtypes`` instead of (mostly) float64
+        self._compact_dtypes = compact_dtypes
+
         # https://twiki.cern.ch/twiki/bin/viewauth/CMS/MissingETOptionalFiltersRun2#Run_3_recommendations
         self.met_filters = [
             "goodVertices",
@@ -85,10 +173,22 @@ class ptSkimmer(SkimmerABC):
     def accumulator(self):
         return self._accumulator
 
+    @classmethod
+    def required_columns(cls) -> set[str]:
+        """All the NanoAOD branches the processor may read"""
+        columns = ak8jets_columns(cls.skim_vars["FatJet"])
+        columns |= {f"HLT_{trigger}" for trigger in cls.HLTs}
+        columns |= {"genWeight"}
+        # gen particle 4-vectors and matching
+        columns |= {f"GenPart_{var}" for var in P4}
+        for gen_selection in gen_selection_dict.values():
+            columns |= set(GEN_SELECTION_COLUMNS[gen_selection])
+        return columns
+
     def process(self, events: ak.Array):
         """Runs event processor for different types of jets"""
 
-        start = time.time()
+        timer = MemoryProfiler() if self._profile_memory else StageTimer()
         print("Starting")
         print("# events", len(events))
 
@@ -103,20 +203,21 @@ class ptSkimmer(SkimmerABC):
 
         cutflow = OrderedDict()
         cutflow["all"] = n_events
-        selection = PackedSelection()
+        selection = CutflowSelection(len(events))
         selection_args = (selection, cutflow, isData, gen_weights)
 
         #########################
         # Object definitions
         #########################
-        print("Starting object definition", f"{time.time() - start:.2f}")
+        print("Starting object definition", f"{timer.stage('setup'):.2f}")
 
         num_fatjets = 2  # number to save
-        fatjets = get_ak8jets(events.FatJet)
+        # only the derived fields which are saved are computed
+        fatjets = get_ak8jets(events.FatJet, list(self.skim_vars["FatJet"]))
 
         ak4_jets = events.Jet
         
-        print("Object definition", f"{time.time() - start:.2f}")
+        print("Object definition", f"{timer.stage('objects'):.2f}")
 
         #########################
         # Derive variables
@@ -129,123 +230,130 @@ class ptSkimmer(SkimmerABC):
                 vars_dict = gen_selection_dict[d](events, ak4_jets, fatjets, selection_args, P4)
                 genVars = {**genVars, **vars_dict}
 
+        timer.stage("gen_selection")
+
         # used for normalization to cross section below
-        gen_selected = (
-            selection.all(*selection.names)
-            if len(selection.names)
-            else np.ones(len(events)).astype(bool)
-        )
+        gen_selected = selection.cumulative
+
+        #########################
+        # Selection Starts
+        #########################
+
+        print("Selection", f"{timer.elapsed:.2f}")
+
+        sel_all = selection.cumulative
+
+        # the weights are computed for the events passing the gen selection (for the totals),
+        # and the skimmed variables below only for the selected events
+        gen_events = events if gen_selected.all() else events[gen_selected]
+        n_selected = np.sum(sel_all)
+        genVars = {key: value.reshape(len(events), -1)[sel_all] for (key, value) in genVars.items()}
+        if not sel_all.all():
+            events = events[sel_all]
+            fatjets = fatjets[sel_all]
+
+        timer.stage("selection")
 
         # FatJet variables
         fatjet_skimvars = self.skim_vars["FatJet"]
+        padded_fatjets = pad_fields(fatjets, list(fatjet_skimvars), num_fatjets)
         ak8FatJetVars = {
-            f"ak8FatJet{key}": pad_val(fatjets[var], num_fatjets, axis=1)
-            for (var, key) in fatjet_skimvars.items()
+            f"ak8FatJet{key}": padded_fatjets[var] for (var, key) in fatjet_skimvars.items()
         }
 
-        print("FatJet vars", f"{time.time() - start:.2f}")
-
-
-        HLTs = [
-            # offline triggers
-            "QuadPFJet70_50_40_35_PFBTagParticleNet_2BTagSum0p65",
-            "PFHT1050",
-            "AK8PFJet230_SoftDropMass40_PFAK8ParticleNetBB0p35",
-            "AK8PFJet250_SoftDropMass40_PFAK8ParticleNetBB0p35",
-            "AK8PFJet275_SoftDropMass40_PFAK8ParticleNetBB0p35",
-            "AK8PFJet230_SoftDropMass40",
-            "AK8PFJet425_SoftDropMass40",
-            "AK8PFJet400_SoftDropMass40",
-            "AK8DiPFJet250_250_MassSD50",
-            "AK8DiPFJet260_260_MassSD30",
-            "AK8PFJet420_MassSD30",
-            "AK8PFJet230_SoftDropMass40_PNetBB0p06",
-            "AK8PFJet230_SoftDropMass40_PNetBB0p10",
-            "AK8PFJet250_SoftDropMass40_PNetBB0p06",
-            # parking triggers
-            # HHparking
-            "PFHT280_QuadPFJet30_PNet2BTagMean0p55",
-            # VBFparking
-            # https://its.cern.ch/jira/browse/CMSHLT-3058
-            "DiJet110_35_Mjj650_PFMET110",
-            "TripleJet110_35_35_Mjj650_PFMET110",
-            "VBF_DiPFJet80_45_Mjj650_PFMETNoMu85",
-            "VBF_DiPFJet110_35_Mjj650",
-            "VBF_DiPFJet110_35_Mjj650_TriplePFJet",
-            "VBF_DiPFJet110_40_Mjj1000_Detajj3p5",
-            "VBF_DiPFJet110_40_Mjj1000_Detajj3p5_TriplePFJet",
-            "VBF_DiJet_60_30_Mass500_DiJet50",
-            "VBF_DiJet_110_35_Mass620",
-            # SingleMuonparking
-            "Mu12_IP6",
-        ]
-        zeros = np.zeros(len(events), dtype="bool")
-        HLTVars = {
-            trigger: (
-                events.HLT[trigger].to_numpy().astype(int)
-                if trigger in events.HLT.fields
-                else zeros
-            )
-            for trigger in HLTs
-        }
-        
+        print("FatJet vars", f"{timer.stage('fatjet_vars'):.2f}")
+
+
+        zeros = np.zeros(n_selected, dtype="bool")
+        if self._pack_triggers:
+            # bit i is self.HLTs[i], whether or not the trigger is in this file
+            hlt_fields = set(events.HLT.fields)
+            HLTVars = {
+                "HLTBits": pack_bits(
+                    np.stack(
+                        [
+                            events.HLT[trigger].to_numpy() if trigger in hlt_fields else zeros
+                            for trigger in self.HLTs
+                        ],
+                        axis=1,
+                    )
+                )
+            }
+        else:
+            HLTVars = {
+                trigger: (
+                    events.HLT[trigger].to_numpy().astype(int)
+                    if trigger in events.HLT.fields
+                    else zeros
+                )
+                for trigger in self.HLTs
+            }
+
         skimmed_events = {
             **genVars,
             **ak8FatJetVars,
             **HLTVars,
         }
 
-        print("Vars", f"{time.time() - start:.2f}")
-
-        #########################
-        # Selection Starts
-        #########################
-
-        print("Selection", f"{time.time() - start:.2f}")
+        print("Vars", f"{timer.stage('trigger_vars'):.2f}")
 
         ######################
         # Weights
         ######################
 
-        # used for normalization to cross section below
-        gen_selected = (
-            selection.all(*selection.names)
-            if len(selection.names)
-            else np.ones(len(events)).astype(bool)
-        )
-
         totals_dict = {"nevents": n_events}
 
         if isData:
-            skimmed_events["weight"] = np.ones(n_events)
+            skimmed_events["weight"] = np.ones(n_selected)
         else:
             weights_dict, totals_temp = self.add_weights(
-                events,
+                gen_events,
                 year,
                 dataset,
-                gen_weights,
-                gen_selected,
+                gen_weights[gen_selected],
+                np.ones(np.sum(gen_selected)).astype(bool),
             )
-            skimmed_events = {**skimmed_events, **weights_dict}
+            skimmed_events = {
+                **skimmed_events,
+                **{key: value[sel_all[gen_selected]] for (key, value) in weights_dict.items()},
+            }
             totals_dict = {**totals_dict, **totals_temp}
 
-        ##############################
-        # Reshape and apply selections
-        ##############################
-
-        sel_all = selection.all(*selection.names) if len(selection.names) else np.ones(len(events)).astype(bool)
+        timer.stage("weights")
 
         skimmed_events = {
-            key: value.reshape(len(skimmed_events["weight"]), -1)[sel_all]
-            for (key, value) in skimmed_events.items()
+            key: value.reshape(n_selected, -1) for (key, value) in skimmed_events.items()
         }
 
-        dataframe = self.to_pandas(skimmed_events)
+        if self._compact_dtypes:
+            skimmed_events = compact_dtypes(skimmed_events, self.output_dtypes)
+
+        table = (
+            self.to_arrow(skimmed_events)
+            if self._arrow_output
+            else self.to_pandas(skimmed_events)
+        )
         fname = events.behavior["__events_factory__"]._partition_key.replace("/", "_") + ".parquet"
-        self.dump_table(dataframe, fname)
+        metadata = (
+            {TRIGGER_BITS_KEY: json.dumps({trigger: i for i, trigger in enumerate(self.HLTs)})}
+            if self._pack_triggers
+            else None
+        )
+        self.dump_table(table, fname, metadata=metadata)
+
+        print("Return ", f"{timer.stage('output'):.2f}")
 
-        print("Return ", f"{time.time() - start:.2f}")
-        return {year: {dataset: {"nevents": n_events, "cutflow": cutflow}}}
+        output = {"nevents": n_events, "cutflow": cutflow, "timing": timer.times}
+
+        if self._profile_memory:
+            timer.nbytes("fatjets", fatjets)
+            if not isData:
+                timer.nbytes("GenPart", events.GenPart)
+            timer.nbytes("skimmed_events", skimmed_events)
+            timer.stop()
+            output["memory"] = timer.memory
+
+        return {year: {dataset: output}}
 
     def postprocess(self, accumulator):
         return accumulator
@@ -292,3 +400,9 @@ class ptSkimmer(SkimmerABC):
         weights_dict["weight_noxsec"] = weights.weight()
 
         return weights_dict, totals_dict
+
+
+class ptSkimmerSchema(PrunedNanoAODSchema):
+    """NanoAOD schema exposing only the branches read by ``ptSkimmer``"""
+
+    columns = frozenset(ptSkimmer.required_columns())
@@ -6,9 +6,17 @@ Author(s): Raghav Kansal
 
 from __future__ import annotations
 
+import json
+import time
+import tracemalloc
+
 import awkward as ak
+import numba
 import numpy as np
 from coffea.analysis_tools import PackedSelection
+from coffea.nanoevents import NanoAODSchema
+
+from hpt.memory import get_peak_rss
 
 P4 = {
     "eta": "Eta",
@@ -19,6 +27,8 @@ P4 = {
 
 
 PAD_VAL = -99999
+# padding of integer variables with compact dtypes, which can't hold ``PAD_VAL``
+INT_PAD_VAL = -1
 
 
 def pad_val(
@@ -37,6 +47,170 @@ def pad_val(
     return ret.to_numpy() if to_numpy else ret
 
 
+def pad_fields(
+    arr: ak.Array, fields: list[str], target: int, value: float = PAD_VAL
+) -> dict[str, np.ndarray]:
+    """
+    ``pad_val(arr[field], target, value, axis=1)`` for each of the ``fields`` of the jagged
+    record array ``arr`` (e.g. jets), with the same values and dtypes. The indices of the kept
+    elements are computed once from the offsets shared by the fields, and fields with the same
+    dtype are filled into one preallocated (n_fields, n_events, target) buffer.
+    """
+    counts = ak.num(arr, axis=1).to_numpy()
+    starts = np.cumsum(counts) - counts
+    # (event, position) of the elements kept, and their index in the flattened fields
+    kept = np.arange(target) < counts[:, None]
+    index = (starts[:, None] + np.arange(target))[kept]
+
+    flat = {}
+    for field in fields:
+        values = ak.to_numpy(ak.flatten(arr[field], axis=1), allow_missing=True)
+        if isinstance(values, np.ma.MaskedArray):
+            values = np.where(np.ma.getmaskarray(values), value, np.ma.getdata(values))
+        # same promotion as ``ak.fill_none`` in ``pad_val``
+        flat[field] = values.astype(np.result_type(values.dtype, np.asarray(value).dtype))
+
+    padded = {}
+    for dtype in {values.dtype for values in flat.values()}:
+        group = [field for field in fields if flat[field].dtype == dtype]
+        buffer = np.full((len(group), len(counts), target), value, dtype=dtype)
+        for i, field in enumerate(group):
+            buffer[i][kept] = flat[field][index]
+            padded[field] = buffer[i]
+
+    return {field: padded[field] for field in fields}
+
+
+@numba.njit
+def _better(a, b, ascending):
+    # NaNs are ranked first in either order, as in ``ak.argsort``
+    if a != a:
+        return b == b
+    if b != b:
+        return False
+    return a < b if ascending else a > b
+
+
+@numba.njit
+def _top_k_kernel(offsets, values, mask, k, ascending, index, counts):
+    for event in range(len(offsets) - 1):
+        n = 0
+        for i in range(offsets[event], offsets[event + 1]):
+            if not mask[i]:
+                continue
+
+            # insert after the kept elements at least as good, so that ties keep their order
+            pos = n
+            while pos > 0 and _better(
+                values[i], values[offsets[event] + index[event, pos - 1]], ascending
+            ):
+                pos -= 1
+            if pos == k:
+                continue
+
+            n = min(n + 1, k)
+            for j in range(n - 1, pos, -1):
+                index[event, j] = index[event, j - 1]
+            index[event, pos] = i - offsets[event]
+
+        counts[event] = n
+
+
+def top_k(values: ak.Array, k: int, mask: ak.Array = None, ascending: bool = False) -> ak.Array:
+    """
+    Local indices of the (up to) ``k`` largest jagged ``values`` (or smallest if ``ascending``)
+    per event, among those passing ``mask`` if given, best first. The same order as a stable
+    ``ak.argsort`` (e.g. ties keep their order), in one pass over the events with a ``k``-sized
+    insertion buffer instead of sorting all the values.
+    """
+    counts = ak.num(values, axis=1).to_numpy()
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    flat = ak.flatten(values, axis=1).to_numpy()
+    flat_mask = (
+        np.ones(len(flat), dtype=bool) if mask is None else ak.flatten(mask, axis=1).to_numpy()
+    )
+
+    index = np.zeros((len(counts), k), dtype=np.int64)
+    ntop = np.zeros(len(counts), dtype=np.int64)
+    _top_k_kernel(offsets, flat, flat_mask, k, ascending, index, ntop)
+    return ak.unflatten(index[np.arange(k) < ntop[:, None]], ntop)
+
+
+def compact_dtypes(
+    events: dict[str, np.ndarray], dtypes: dict[str, np.dtype]
+) -> dict[str, np.ndarray]:
+    """
+    Converts the (``pad_val`` padded) arrays in ``events`` to compact dtypes: to ``dtypes[key]``
+    if given, else floats to float32. ``PAD_VAL`` padding becomes ``INT_PAD_VAL`` for
+    integers and False for booleans, and stays ``PAD_VAL`` for floats.
+    """
+    compact = {}
+    for key, arr in events.items():
+        dtype = np.dtype(dtypes.get(key, np.float32 if arr.dtype.kind == "f" else arr.dtype))
+        if dtype.kind == "b":
+            arr = np.where(arr == PAD_VAL, False, arr)
+        elif dtype.kind in "iu":
+            arr = np.where(arr == PAD_VAL, INT_PAD_VAL, arr)
+        compact[key] = arr.astype(dtype, copy=False)
+    return compact
+
+
+# parquet metadata key of the trigger name -> bit map of the packed trigger word
+TRIGGER_BITS_KEY = "hlt_bits"
+
+
+def pack_bits(flags: np.ndarray) -> np.ndarray:
+    """
+    Packs the (n, nbits) boolean array ``flags`` into n unsigned integers, with column i as bit i:
+    uint32 for up to 32 columns, uint64 for up to 64.
+    """
+    nbits = flags.shape[1]
+    if nbits > 64:
+        raise ValueError(f"Can't pack {nbits} bits into one integer")
+
+    dtype = np.dtype(np.uint32 if nbits <= 32 else np.uint64)
+    packed = np.packbits(flags.astype(bool), axis=1, bitorder="little")
+    words = np.zeros((len(flags), dtype.itemsize), dtype=np.uint8)
+    words[:, : packed.shape[1]] = packed
+    return words.view(dtype.newbyteorder("<")).reshape(-1).astype(dtype)
+
+
+def unpack_bits(words: np.ndarray, bits: dict[str, int]) -> dict[str, np.ndarray]:
+    """
+    Per-name 0 / 1 integer arrays of the bits (name -> bit) in the packed integers ``words``,
+    i.e. the inverse of ``pack_bits``
+    """
+    words = np.asarray(words).reshape(-1)
+    return {name: ((words >> words.dtype.type(bit)) & 1).astype(int) for name, bit in bits.items()}
+
+
+def read_trigger_bits(fname: str) -> dict[str, int]:
+    """Trigger name -> bit map of the packed trigger word in the parquet file ``fname``"""
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_schema(fname).metadata or {}
+    if TRIGGER_BITS_KEY.encode() not in metadata:
+        raise KeyError(f"No packed triggers in {fname}")
+    return json.loads(metadata[TRIGGER_BITS_KEY.encode()])
+
+
+class CutflowSelection(PackedSelection):
+    """
+    ``PackedSelection`` of ``n_events`` events which also keeps ``cumulative``, the mask of the
+    events passing all the selections added so far (all True before any is added), updated with
+    each new selection instead of recomputing ``all(*names)`` over every selection for each cut.
+    """
+
+    def __init__(self, n_events: int, dtype="uint32"):
+        super().__init__(dtype)
+        self.cumulative = np.ones(n_events, dtype=bool)
+
+    def add(self, name, selection, fill_value=False):
+        super().add(name, selection, fill_value)
+        # not in place, as previous masks may still be in use
+        self.cumulative = self.cumulative & self.all(name)
+
+
 def add_selection(
     name: str,
     sel: np.ndarray,
@@ -50,11 +224,16 @@ def add_selection(
         sel = sel.to_numpy()
 
     selection.add(name, sel.astype(bool))
+    selected = (
+        selection.cumulative
+        if isinstance(selection, CutflowSelection)
+        else selection.all(*selection.names)
+    )
     cutflow[name] = (
-        np.sum(selection.all(*selection.names))
+        np.sum(selected)
         if isData
         # add up genWeights for MC
-        else np.sum(genWeights[selection.all(*selection.names)])
+        else np.sum(genWeights[selected])
     )
 
 
@@ -67,35 +246,194 @@ def add_selection_no_cutflow(
     selection.add(name, ak.fill_none(sel, False))
 
 
-def concatenate_dicts(dicts_list: list[dict[str, np.ndarray]]):
-    """given a list of dicts of numpy arrays, concatenates the numpy arrays across the lists"""
-    if len(dicts_list) > 1:
+class StageTimer:
+    """
+    Times the named stages of a processor with ``time.perf_counter``: each stage lasts from the
+    end of the previous one until ``stage(name)``. ``times`` (in s) can be returned in the
+    accumulator, and summed over chunks and jobs.
+    """
+
+    def __init__(self):
+        self.start = self._last = time.perf_counter()
+        self.times = {}
+
+    @property
+    def elapsed(self) -> float:
+        """Time since the start (in s)"""
+        return time.perf_counter() - self.start
+
+    def stage(self, name: str) -> float:
+        """Ends stage ``name``, returns the time since the start (in s)"""
+        now = time.perf_counter()
+        self.times[name] = self.times.get(name, 0.0) + now - self._last
+        self._last = now
+        return now - self.start
+
+
+class Peak(float):
+    """Number which accumulates to the maximum instead of the sum, e.g. peak memory over chunks"""
+
+    def __add__(self, other):
+        return Peak(max(self, other))
+
+    __radd__ = __add__
+
+
+def _virtual_nbytes(layout) -> int:
+    """Bytes of the materialized virtual (lazily read) arrays in ``layout``"""
+    if isinstance(layout, ak.layout.VirtualArray):
+        array = layout.peek_array
+        return 0 if array is None else array.nbytes + _virtual_nbytes(array)
+    if hasattr(layout, "contents"):
+        return sum(_virtual_nbytes(content) for content in layout.contents)
+    if hasattr(layout, "content"):
+        return _virtual_nbytes(layout.content)
+    return 0
+
+
+def materialized_nbytes(arr: ak.Array | np.ndarray) -> int:
+    """
+    Bytes in memory of ``arr``, including the branches NanoEvents has read so far, which
+    ``ak.Array.nbytes`` ignores, without reading any others
+    """
+    if isinstance(arr, ak.Array):
+        return arr.layout.nbytes + _virtual_nbytes(arr.layout)
+    return arr.nbytes
+
+
+class MemoryProfiler(StageTimer):
+    """
+    ``StageTimer`` which also records, in MB, for each stage:
+
+    - ``rss``: the peak RSS of the process up to the end of the stage, i.e. since the start of
+      the chunk if the runner resets it (the stage where it jumps is the one using the memory)
+    - ``tracemalloc``: the peak memory allocated by python / numpy during the stage
+
+    and the bytes of the materialized buffers of arrays with ``nbytes(name, arrays)``,
+    in ``memory``. Values are ``Peak`` s, so the maximum is kept over chunks.
+    tracemalloc slows down the processing, so this is meant to be optional.
+    """
+
+    def __init__(self):
+        self._start_tracing = not tracemalloc.is_tracing()
+        if self._start_tracing:
+            tracemalloc.start()
+        self._reset_tracemalloc_peak()
+        self.memory = {"rss": {}, "tracemalloc": {}, "nbytes": {}}
+        super().__init__()
+
+    @staticmethod
+    def _reset_tracemalloc_peak():
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        else:
+            # python < 3.9
+            tracemalloc.clear_traces()
+
+    def stage(self, name: str) -> float:
+        elapsed = super().stage(name)
+        self.memory["rss"][name] = Peak(get_peak_rss())
+        self.memory["tracemalloc"][name] = Peak(tracemalloc.get_traced_memory()[1] / 1024**2)
+        self._reset_tracemalloc_peak()
+        return elapsed
+
+    def nbytes(self, name: str, arrays):
+        """Records the size of the awkward / numpy ``arrays`` (an array or a dict of arrays)"""
+        arrays = arrays.values() if isinstance(arrays, dict) else [arrays]
+        self.memory["nbytes"][name] = Peak(
+            sum(materialized_nbytes(arr) for arr in arrays) / 1024**2
+        )
+
+    def stop(self):
+        if self._start_tracing:
+            tracemalloc.stop()
+
+
+def _buffer(out: dict | None, key: str, shape: tuple, dtype) -> np.ndarray:
+    """
+    Array of ``shape`` to write ``key`` into: a view of the buffer ``out[key]`` if it is large
+    enough, else a new array (kept in ``out`` to be reused)
+    """
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+
+    buffer = out.get(key)
+    if (
+        buffer is None
+        or buffer.dtype != dtype
+        or buffer.shape[1:] != shape[1:]
+        or len(buffer) < shape[0]
+    ):
+        buffer = out[key] = np.empty(shape, dtype=dtype)
+    return buffer[: shape[0]]
+
+
+def concatenate_dicts(dicts_list: list[dict[str, np.ndarray]], out: dict = None):
+    """
+    given a list of dicts of numpy arrays, concatenates the numpy arrays across the lists
+
+    Each output array is allocated once and filled in place. To reuse the allocations across
+    chunks, pass the same (initially empty) dict as ``out`` each time: it keeps one buffer per
+    key, replaced by a larger one when needed. The outputs are then views of these buffers,
+    overwritten by the next call with the same ``out``.
+    """
+    if len(dicts_list) == 1:
+        return dicts_list[0]
+
+    concatenated = {}
+    for key in dicts_list[0]:
+        arrays = [d[key].reshape(d[key].shape[0], -1) for d in dicts_list]
+        shape = (arrays[0].shape[0], sum(arr.shape[1] for arr in arrays))
+        concatenated[key] = _buffer(out, key, shape, np.result_type(*arrays))
+
+        start = 0
+        for arr in arrays:
+            concatenated[key][:, start : start + arr.shape[1]] = arr
+            start += arr.shape[1]
+
+    return concatenated
+
+
+def select_dicts(dicts_list: list[dict[str, np.ndarray]], sel: np.ndarray, out: dict = None):
+    """
+    given a list of dicts of numpy arrays, select the entries per array across the lists
+    according to ``sel``
+
+    i.e. ``np.stack`` of the arrays of each key along axis 1, indexed with ``sel``: a boolean
+    mask of the events (n_events) or of the entries per list (n_events, n_lists). With a mask,
+    only the selected entries are gathered, into an array allocated once or into the buffers
+    in ``out`` (see ``concatenate_dicts``).
+    """
+    sel = np.asarray(sel)
+    if sel.dtype != bool or sel.ndim > 2:
+        # integer / multi-dimensional indices: stack first
         return {
-            key: np.concatenate(
-                [
-                    dicts_list[i][key].reshape(dicts_list[i][key].shape[0], -1)
-                    for i in range(len(dicts_list))
-                ],
-                axis=1,
-            )
+            key: np.stack([d[key].reshape(d[key].shape[0], -1) for d in dicts_list], axis=1)[sel]
             for key in dicts_list[0]
         }
 
-    return dicts_list[0]
+    index = np.nonzero(sel)
+    if sel.ndim == 2:
+        # rows of the selected entries of each list, and their positions in the output
+        lists = [
+            (index[0][index[1] == i], np.flatnonzero(index[1] == i)) for i in range(len(dicts_list))
+        ]
 
+    selected = {}
+    for key in dicts_list[0]:
+        arrays = [d[key].reshape(d[key].shape[0], -1) for d in dicts_list]
+        dtype = np.result_type(*arrays)
+        if sel.ndim == 1:
+            shape = (len(index[0]), len(arrays), arrays[0].shape[1])
+            selected[key] = _buffer(out, key, shape, dtype)
+            for i, arr in enumerate(arrays):
+                selected[key][:, i] = arr[index[0]]
+        else:
+            selected[key] = _buffer(out, key, (len(index[0]), arrays[0].shape[1]), dtype)
+            for arr, (rows, positions) in zip(arrays, lists):
+                selected[key][positions] = arr[rows]
 
-def select_dicts(dicts_list: list[dict[str, np.ndarray]], sel: np.ndarray):
-    """given a list of dicts of numpy arrays, select the entries per array across the lists according to ``sel``"""
-    return {
-        key: np.stack(
-            [
-                dicts_list[i][key].reshape(dicts_list[i][key].shape[0], -1)
-                for i in range(len(dicts_list))
-            ],
-            axis=1,
-        )[sel]
-        for key in dicts_list[0]
-    }
+    return selected
 
 
 def remove_variation_suffix(var: str):
@@ -105,3 +443,25 @@ def remove_variation_suffix(var: str):
     elif var.endswith("Up"):
         return var.split("Up")[0]
     return var
+
+
+class PrunedNanoAODSchema(NanoAODSchema):
+    """
+    ``NanoAODSchema`` exposing only the branches in ``columns`` (and the counts of their
+    collections), so that no other branches are decompressed or transferred, and reading any
+    other branch or collection fails with an ``AttributeError``.
+    Subclass it with the ``columns`` declared by a processor.
+    """
+
+    columns: frozenset = frozenset()
+    # cross-references to pruned collections are dropped on purpose
+    warn_missing_crossrefs = False
+
+    def __init__(self, base_form, version="latest"):
+        collections = {column.split("_")[0] for column in self.columns}
+        contents = {
+            key: form
+            for key, form in base_form["contents"].items()
+            if key in self.columns or (key.startswith("n") and key[1:] in collections)
+        }
+        super().__init__({**base_form, "contents": contents}, version)
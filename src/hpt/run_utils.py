@@ -1,15 +1,21 @@
 # from distributed.diagnostics.plugin import WorkerPlugin
 from __future__ import annotations
 
+import concurrent.futures
 import json
+import multiprocessing
 import os
 import subprocess
 import sys
+import threading
+from collections import deque
+from functools import partial
 from pathlib import Path
 
 import numpy as np
 from colorama import Fore, Style
 
+from .memory import get_peak_rss, get_rss, release_memory, reset_peak_rss  # noqa: F401
 from .xsecs import xsecs
 
 
@@ -34,6 +40,152 @@ def add_mixins(nanoevents):
     nanoevents.PFNanoAODSchema.mixins["SV"] = "PFCand"
 
 
+def setup_worker(file_cache: str = None, file_cache_size: float = 20.0):
+    """
+    Applies the uproot / nanoevents settings of ``run`` in this (main or worker) process.
+    xrootd files are read through a local disk cache in ``file_cache`` if given.
+    """
+    import uproot
+    from coffea import nanoevents
+
+    add_mixins(nanoevents)
+    uproot.open.defaults["xrootd_handler"] = uproot.source.xrootd.MultithreadedXRootDSource
+
+    if file_cache is not None:
+        from .file_cache import set_file_cache
+
+        set_file_cache(file_cache, file_cache_size)
+
+
+def _call_in_worker(fn, args, kwargs):
+    """Runs ``fn`` in a pool worker and returns its output and the worker's RSS afterwards"""
+    out = fn(*args, **kwargs)
+    release_memory()
+    return out, get_rss()
+
+
+class RecyclingProcessPool(concurrent.futures.Executor):
+    """
+    Process pool in which a worker process is replaced by a fresh one after ``max_tasks`` tasks,
+    or as soon as its RSS is above ``max_rss`` MB after a task, so that memory which is not
+    released between chunks can't build up.
+
+    Can be passed as the ``pool`` of a ``coffea.processor.FuturesExecutor``.
+
+    Args:
+        max_workers (int): number of worker processes
+        max_tasks (int, optional): recycle a worker after this many tasks
+        max_rss (float, optional): recycle a worker once its RSS is above this (in MB)
+        initializer (callable, optional): called at the start of each worker process
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_tasks: int = None,
+        max_rss: float = None,
+        initializer=None,
+    ):
+        self._max_tasks = max_tasks
+        self._max_rss = max_rss
+        self._initializer = initializer
+        # a clean (single threaded) server process to fork the workers from
+        self._context = multiprocessing.get_context("forkserver")
+        self._context.set_forkserver_preload(["coffea.processor", "hpt.processors"])
+
+        self._workers = [self._new_worker() for _ in range(max_workers)]
+        self._ntasks = [0] * max_workers
+        self._free = list(range(max_workers))
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self.nrecycled = 0
+
+    def _new_worker(self):
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=self._context, initializer=self._initializer
+        )
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            self._queue.append((future, fn, args, kwargs))
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        """Sends queued tasks to free workers"""
+        while True:
+            with self._lock:
+                if not (self._free and self._queue):
+                    return
+
+                future, fn, args, kwargs = self._queue.popleft()
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                i = self._free.pop()
+                worker = self._workers[i]
+
+            # outside the lock, as the callback runs right away if the task is already done
+            try:
+                task = worker.submit(_call_in_worker, fn, args, kwargs)
+            except BaseException as e:
+                # e.g. ``BrokenProcessPool`` if the worker died in between tasks
+                future.set_exception(e)
+                self._release(i, recycle=True)
+                continue
+
+            task.add_done_callback(partial(self._task_done, i, future))
+
+    def _task_done(
+        self, i: int, future: concurrent.futures.Future, task: concurrent.futures.Future
+    ):
+        recycle = True
+        try:
+            out, rss = task.result()
+        except BaseException as e:
+            # worker might have died (e.g. killed for using too much memory), so replace it anyway
+            future.set_exception(e)
+        else:
+            future.set_result(out)
+            self._ntasks[i] += 1
+            recycle = (self._max_tasks and self._ntasks[i] >= self._max_tasks) or (
+                self._max_rss and rss > self._max_rss
+            )
+            if self._max_rss and rss > self._max_rss:
+                print(f"Worker RSS {rss:.0f} MB is above {self._max_rss} MB, recycling worker")
+
+        self._release(i, recycle)
+        self._dispatch()
+
+    def _release(self, i: int, recycle: bool):
+        """Frees worker ``i``, replacing it by a fresh worker process if ``recycle``"""
+        with self._lock:
+            if self._shutdown:
+                return
+
+            if recycle:
+                self._workers[i].shutdown(wait=False)
+                self._workers[i] = self._new_worker()
+                self._ntasks[i] = 0
+                self.nrecycled += 1
+
+            self._free.append(i)
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        with self._lock:
+            self._shutdown = True
+            if cancel_futures:
+                while self._queue:
+                    self._queue.popleft()[0].cancel()
+
+        for worker in self._workers:
+            worker.shutdown(wait=wait)
+
+
 def print_red(s):
     return print(f"{Fore.RED}{s}{Style.RESET_ALL}")
 
@@ -127,19 +279,57 @@ def get_fileset(
     return fileset
 
 
+def get_replicas(version: str) -> dict[str, list[str]]:
+    """
+    Alternative replicas of the input files, keyed by logical file name,
+    if they've been saved by ``data/make_filelists.py``.
+    """
+    replicas_file = Path(f"data/nanoindex_{version}_replicas.json")
+    if not replicas_file.exists():
+        return {}
+
+    with replicas_file.open() as f:
+        return json.load(f)
+
+
 def get_processor(
     processor: str,
     save_array: bool = False,
     apply_selection: bool | None = None,
     nano_version: str | None = None,
+    arrow_output: bool = False,
+    profile_memory: bool = False,
+    pack_triggers: bool = False,
+    compact_dtypes: bool = False,
 ):
     # define processor
     if processor == "ptSkimmer":
         from hpt.processors import ptSkimmer
         return ptSkimmer(
             xsecs=xsecs,
+            arrow_output=arrow_output,
+            profile_memory=profile_memory,
+            pack_triggers=pack_triggers,
+            compact_dtypes=compact_dtypes,
         )
 
+def get_schema(processor: str, prune_branches: bool = False):
+    """
+    NanoEvents schema for ``processor``, optionally exposing only the branches it declares
+    """
+    from coffea import nanoevents
+
+    if not prune_branches:
+        return nanoevents.NanoAODSchema
+
+    if processor == "ptSkimmer":
+        from hpt.processors import ptSkimmerSchema
+
+        return ptSkimmerSchema
+
+    raise ValueError(f"No pruned schema for processor {processor}")
+
+
 def parse_common_args(parser):
     parser.add_argument(
         "--processor",
@@ -182,6 +372,165 @@ def parse_common_args(parser):
     parser.add_argument("--chunksize", default=10000, help="chunk size", type=int)
     add_bool_arg(parser, "save-array", default=False, help="save array (for dask)")
     add_bool_arg(parser, "save-root", default=False, help="save root ntuples too")
+    add_bool_arg(
+        parser,
+        "arrow-output",
+        default=False,
+        help="write outputs directly with pyarrow (fixed size list columns) instead of pandas",
+    )
+    add_bool_arg(
+        parser,
+        "profile-memory",
+        default=False,
+        help="record the peak RSS and tracemalloc peak of each processor stage (slower)",
+    )
+    add_bool_arg(
+        parser,
+        "pack-triggers",
+        default=False,
+        help="save the triggers as the bits of one integer column, HLTBits",
+    )
+    add_bool_arg(
+        parser,
+        "compact-dtypes",
+        default=False,
+        help="save the outputs as float32 / int8 / bool instead of (mostly) float64 / int64",
+    )
+    parser.add_argument(
+        "--metadata-cache",
+        default=None,
+        help="JSON file caching the number of entries and UUIDs of the input files, "
+        "to skip opening them for the preprocessing",
+        type=str,
+    )
+    add_bool_arg(
+        parser,
+        "prune-branches",
+        default=False,
+        help="only read the NanoAOD branches declared by the processor (reading others fails)",
+    )
+
+
+def timing_summary(out: dict):
+    """
+    Per-dataset breakdown of the processing time (in s, summed over chunks / jobs) of each
+    stage of the processor, from the ``timing`` of its (accumulated) output ``out``.
+    """
+    import pandas as pd
+
+    timing = {
+        (year, dataset): dataset_out["timing"]
+        for year, year_out in out.items()
+        for dataset, dataset_out in year_out.items()
+        if "timing" in dataset_out
+    }
+    df = pd.DataFrame.from_dict(timing, orient="index").fillna(0)
+    df["total"] = df.sum(axis=1)
+    return df
+
+
+def memory_summary(out: dict):
+    """
+    Per-dataset peak memory (in MB, maximum over chunks / jobs) of each stage of the processor
+    and size of its main arrays, from the ``memory`` of its (accumulated) output ``out``.
+    """
+    import pandas as pd
+
+    memory = {
+        (year, dataset): {
+            (kind, name): value
+            for kind, values in dataset_out["memory"].items()
+            for name, value in values.items()
+        }
+        for year, year_out in out.items()
+        for dataset, dataset_out in year_out.items()
+        if "memory" in dataset_out
+    }
+    return pd.DataFrame.from_dict(memory, orient="index")
+
+
+def _nulls(n: int, dtype):
+    """Array of ``n`` nulls of type ``dtype``"""
+    import pyarrow as pa
+
+    if isinstance(dtype, pa.FixedSizeListType):
+        # lists of nulls, as null lists can't be read back from parquet in pyarrow 12
+        values = pa.nulls(n * dtype.list_size, dtype.value_type)
+        return pa.FixedSizeListArray.from_arrays(values, dtype.list_size)
+    return pa.nulls(n, dtype)
+
+
+def merge_parquet(parquet_dir: Path, out_file: str, row_group_size: int = 100000) -> int:
+    """
+    Merges the (per-chunk) parquet files in ``parquet_dir`` into a single ``out_file``.
+    Files are read one record batch at a time and written out in row groups of
+    ``row_group_size`` rows, so only about one row group is in memory at once.
+
+    Returns the number of rows written.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    fnames = sorted(Path(parquet_dir).glob("*.parquet"))
+    if not len(fnames):
+        print_red(f"No parquet files to merge in {parquet_dir}!")
+        return 0
+
+    schemas = [pq.read_schema(fname) for fname in fnames]
+    nrows = sum(pq.read_metadata(fname).num_rows for fname in fnames)
+
+    # files can have different columns, e.g. with gen variables only for MC. A column's type is
+    # taken from the first file with it, to which the others are cast (e.g. triggers missing in
+    # some of the files are saved as booleans), as ``unify_schemas`` requires matching types
+    types = {}
+    for file_schema in schemas:
+        for field in file_schema:
+            types.setdefault(field.name, field.type)
+    schema = pa.unify_schemas(
+        [
+            pa.schema([field.with_type(types[field.name]) for field in s], metadata=s.metadata)
+            for s in schemas
+        ]
+    )
+
+    # update the pandas index stored in the metadata to cover the merged rows
+    if schema.metadata is not None and b"pandas" in schema.metadata:
+        pandas_meta = json.loads(schema.metadata[b"pandas"])
+        # and the columns, which are described in the metadata of the files with them
+        columns = {
+            column["field_name"]: column
+            for s in reversed(schemas)
+            if s.metadata is not None and b"pandas" in s.metadata
+            for column in json.loads(s.metadata[b"pandas"])["columns"]
+        }
+        pandas_meta["columns"] = [columns[name] for name in schema.names if name in columns]
+        for index in pandas_meta["index_columns"]:
+            if isinstance(index, dict) and index["kind"] == "range":
+                index.update({"start": 0, "stop": nrows, "step": 1})
+        schema = schema.with_metadata({**schema.metadata, b"pandas": json.dumps(pandas_meta)})
+
+    buffer, nbuffer = [], 0
+    with pq.ParquetWriter(out_file, schema) as writer:
+        for fname in fnames:
+            for batch in pq.ParquetFile(fname).iter_batches(batch_size=row_group_size):
+                table = pa.Table.from_batches([batch])
+                if not table.schema.equals(schema, check_metadata=False):
+                    for field in schema:
+                        if field.name not in table.column_names:
+                            table = table.append_column(field, _nulls(len(table), field.type))
+                    table = table.select(schema.names).cast(schema)
+                buffer.append(table)
+                nbuffer += len(table)
+
+                if nbuffer >= row_group_size:
+                    merged = pa.concat_tables(buffer)
+                    writer.write_table(merged.slice(0, row_group_size))
+                    buffer, nbuffer = [merged.slice(row_group_size)], nbuffer - row_group_size
+
+        if nbuffer:
+            writer.write_table(pa.concat_tables(buffer))
+
+    return nrows
 
 
 def flatten_dict(var_dict: dict):
@@ -192,9 +541,101 @@ def flatten_dict(var_dict: dict):
     for key, var in var_dict.items():
         num_objects = var.shape[-1]
         if len(var.shape) >= 2 and num_objects > 1:
-            temp_dict = {f"{key}{obj}": var[:, obj] for obj in range(num_objects)}
-            new_dict = {**new_dict, **temp_dict}
+            new_dict.update({f"{key}{obj}": var[:, obj] for obj in range(num_objects)})
         else:
-            new_dict[key] = np.squeeze(var)
+            # not ``np.squeeze``, which would give a 0-d array for a single event
+            new_dict[key] = var.reshape(len(var))
 
     return new_dict
+
+
+def read_chunk_arrays(fname: Path) -> dict[str, np.ndarray]:
+    """
+    Reads a per-chunk parquet file, written either through pandas (multi-index columns) or
+    directly with pyarrow (fixed size list columns), into a dictionary of (n_events, n) arrays.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(fname)
+
+    if table.schema.metadata is not None and b"pandas" in table.schema.metadata:
+        pddf = table.to_pandas()
+        # take only top-level column names in multiindex df
+        keys = dict.fromkeys(pddf.columns.get_level_values(0))
+        return {key: pddf[key].to_numpy() for key in keys}
+
+    arrays = {}
+    for key, column in zip(table.column_names, table.columns):
+        column = column.combine_chunks()
+        if isinstance(column.type, pa.FixedSizeListType):
+            values = column.flatten().to_numpy(zero_copy_only=False)
+            arrays[key] = values.reshape(len(column), column.type.list_size)
+        else:
+            arrays[key] = column.to_numpy(zero_copy_only=False).reshape(len(column), 1)
+    return arrays
+
+
+class RootWriter(threading.Thread):
+    """
+    Streams the per-chunk parquet files in ``parquet_dir`` into the "Events" tree of the ROOT
+    file ``out_file`` while the processor is still running, one chunk at a time.
+    The tree is created from the first chunk and extended with each following chunk,
+    so only one chunk is in memory at once.
+
+    ``start()`` before running the processor and ``close()`` after, to write the remaining chunks.
+    """
+
+    def __init__(self, parquet_dir: Path, out_file: str, poll_interval: float = 1.0):
+        super().__init__(daemon=True)
+        self.parquet_dir = Path(parquet_dir)
+        self.out_file = out_file
+        self.poll_interval = poll_interval
+        self.nevents = 0
+        self._written = set()
+        self._dtypes = None
+        self._finished = threading.Event()
+        self._exception = None
+
+    def _write_new_chunks(self, rfile):
+        for fname in sorted(self.parquet_dir.glob("*.parquet")):
+            if fname in self._written:
+                continue
+
+            branches = flatten_dict(read_chunk_arrays(fname))
+            nevents = len(next(iter(branches.values())))
+            if nevents:
+                if self._dtypes is None:
+                    rfile["Events"] = branches
+                    self._dtypes = {key: val.dtype for key, val in branches.items()}
+                else:
+                    # e.g. triggers missing in some of the files are saved as booleans
+                    rfile["Events"].extend(
+                        {key: val.astype(self._dtypes[key]) for key, val in branches.items()}
+                    )
+
+            self._written.add(fname)
+            self.nevents += nevents
+
+    def run(self):
+        import uproot
+
+        try:
+            with uproot.recreate(self.out_file, compression=uproot.LZ4(4)) as rfile:
+                while True:
+                    finished = self._finished.is_set()
+                    self._write_new_chunks(rfile)
+                    if finished:
+                        break
+                    self._finished.wait(self.poll_interval)
+        except Exception as e:
+            self._exception = e
+
+    def close(self):
+        """Writes any remaining chunks and closes the file"""
+        self._finished.set()
+        self.join()
+        if self._exception is not None:
+            raise self._exception
+
+        print(f"Saved {self.nevents} events to {self.out_file}")
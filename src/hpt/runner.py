@@ -0,0 +1,446 @@
+"""
+coffea ``Runner`` with per-file / per-chunk retries and replica failover,
+checkpointing of completed chunks, and an adaptive chunksize.
+"""
+
+from __future__ import annotations
+
+import json
+import pickle
+import random
+import time
+import warnings
+from collections.abc import Mapping
+from dataclasses import dataclass, field, replace
+from functools import partial
+from pathlib import Path
+
+import uproot
+from coffea import processor
+from coffea.processor.accumulator import set_accumulator
+from coffea.processor.executor import DaskExecutor, FileMeta, UprootMissTreeError, WorkItem
+
+from .memory import get_peak_rss, get_rss, reset_peak_rss
+
+
+def get_lfn(filename: str) -> str:
+    """Logical file name (``/store/...``) of a physical file name / xrootd url"""
+    i = filename.find("/store/")
+    return filename[i:] if i >= 0 else filename
+
+
+def _exception_chain(e: BaseException) -> list[BaseException]:
+    chain = []
+    while e is not None:
+        chain.append(e)
+        e = e.__cause__ or e.__context__
+    return chain
+
+
+# modules reading the input files, besides the uproot sources
+INPUT_MODULES = ("uproot.source", "XRootD", "hpt.file_cache")
+
+# transient xrootd errors, as in coffea's ``automatic_retries``
+TRANSIENT_ERRORS = ["Invalid redirect URL", "Operation expired", "Socket timeout"]
+
+
+def _raised_reading_input(e: BaseException) -> bool:
+    """Whether ``e`` was raised while reading an input file, i.e. in an uproot source"""
+    tb = e.__traceback__
+    while tb is not None:
+        frame = tb.tb_frame
+        if isinstance(
+            frame.f_locals.get("self"), (uproot.source.chunk.Source, uproot.source.chunk.Resource)
+        ) or frame.f_globals.get("__name__", "").startswith(INPUT_MODULES):
+            return True
+        tb = tb.tb_next
+    return False
+
+
+def _is_read_error(e: Exception) -> bool:
+    """
+    Whether the exception was caused by reading the input file (i.e. worth retrying): errors of
+    the uproot / xrootd sources, missing files and timeouts, but not e.g. errors writing the
+    outputs, missing trees or authentication failures.
+    """
+    chain = _exception_chain(e)
+    if any("Auth failed" in str(c) for c in chain):
+        return False
+    return any(
+        isinstance(c, (FileNotFoundError, TimeoutError))
+        or any(message in str(c) for message in TRANSIENT_ERRORS)
+        or (isinstance(c, OSError) and _raised_reading_input(c))
+        for c in chain
+    )
+
+
+def _is_missing_tree(e: Exception) -> bool:
+    return any(isinstance(c, UprootMissTreeError) for c in _exception_chain(e))
+
+
+def _work_item(item):
+    """The ``WorkItem`` chunk or ``FileMeta`` file of ``item``"""
+    # the dask executor sends chunks as (chunk, processor instance) tuples
+    return item[0] if isinstance(item, tuple) else item
+
+
+def _with_filename(item, filename: str):
+    """Copy of the work item (``WorkItem`` chunk or ``FileMeta`` file) reading ``filename``"""
+    if isinstance(item, tuple):
+        return (_with_filename(item[0], filename), *item[1:])
+    if isinstance(item, FileMeta):
+        return FileMeta(item.dataset, filename, item.treename, item.metadata)
+    return replace(item, filename=filename)
+
+
+def retry_with_failover(
+    replicas: dict[str, list[str]],
+    max_retries: int,
+    backoff: float,
+    max_backoff: float,
+    retries: int,  # noqa: ARG001
+    skipbadfiles: bool,
+    func,
+    item,
+):
+    """
+    Replaces ``coffea.processor.Runner.automatic_retries``: runs ``func`` on a single file
+    (preprocessing) or chunk ``item``, retrying read errors up to ``max_retries`` times per replica
+    with exponential backoff and jitter, before failing over to the next replica of the file.
+    Only the failing file / chunk is retried, never the chunks which have already succeeded.
+    With ``skipbadfiles``, files which can't be read, or don't have the tree, are skipped.
+    """
+    work_item = _work_item(item)
+    filenames = [work_item.filename] + [
+        fname
+        for fname in replicas.get(get_lfn(work_item.filename), [])
+        if fname != work_item.filename
+    ]
+
+    for filename in filenames:
+        for attempt in range(max_retries + 1):
+            try:
+                out = func(_with_filename(item, filename))
+            except Exception as e:
+                if skipbadfiles and _is_missing_tree(e):
+                    # as in coffea, files without the tree are skipped
+                    warnings.warn(f"Skipping {work_item.filename}: {e}", stacklevel=1)
+                    return None
+                if not _is_read_error(e):
+                    raise e
+
+                exception = e
+                if attempt < max_retries:
+                    wait = min(max_backoff, backoff * 2**attempt) * random.uniform(0.5, 1.5)
+                    warnings.warn(
+                        f"Error reading {filename} (attempt {attempt + 1} of {max_retries + 1}): "
+                        f"{e}. Retrying in {wait:.0f}s",
+                        stacklevel=1,
+                    )
+                    time.sleep(wait)
+                continue
+
+            if isinstance(work_item, FileMeta) and filename != work_item.filename:
+                # metadata is looked up by the original filename
+                out = set_accumulator(
+                    FileMeta(
+                        work_item.dataset, work_item.filename, work_item.treename, meta.metadata
+                    )
+                    for meta in out
+                )
+            return out
+
+        if filename != filenames[-1]:
+            warnings.warn(f"Giving up on {filename}, trying the next replica", stacklevel=1)
+
+    if skipbadfiles:
+        warnings.warn(f"Skipping {work_item.filename}: {exception}", stacklevel=1)
+        return None
+
+    raise exception
+
+
+def checkpoint_path(checkpoint_dir: str, item: WorkItem) -> Path:
+    """Checkpoint file of the chunk (file uuid, tree, entry range) ``item``"""
+    treename = item.treename.replace("/", "_")
+    return (
+        Path(checkpoint_dir)
+        / f"{item.fileuuid.hex()}_{treename}_{item.entrystart}-{item.entrystop}.pkl"
+    )
+
+
+def _chunk_key(fname: str) -> tuple[str, str]:
+    """
+    (file uuid, entry range) of the chunk of a checkpoint (``checkpoint_path``) or per-chunk
+    parquet file (named after the chunk's ``_partition_key``: "<uuid>_<tree>_<start>-<stop>")
+    """
+    # chunks are only ever read from one tree per file, which is named differently in the two
+    return fname.split("_")[0].replace("-", ""), Path(fname).stem.rsplit("_", 1)[-1]
+
+
+def prepare_checkpoints(checkpoint_dir: str, parquet_dir: str, chunking: dict) -> int:
+    """
+    Prepares resuming from the checkpoints in ``checkpoint_dir``, returning how many are kept.
+
+    Chunk boundaries only match those of the checkpoints with the same ``chunking`` settings
+    (e.g. chunksize), which are saved alongside them, and never with an adaptive chunksize.
+    Otherwise, the checkpoints are removed, as the chunks replacing them would overlap them.
+    Per-chunk outputs in ``parquet_dir`` without a checkpoint (i.e. from chunks which were not
+    completed, or whose checkpoint was removed) are removed, so that no events are saved twice,
+    as are checkpoints without their output (e.g. lost with the job directory), so that their
+    chunks are processed again.
+    """
+    checkpoint_dir = Path(checkpoint_dir)
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    config = checkpoint_dir / "chunking.json"
+
+    previous = json.loads(config.read_text()) if config.exists() else None
+    if previous != chunking or chunking.get("adaptive"):
+        for path in checkpoint_dir.glob("*.pkl"):
+            path.unlink()
+    config.write_text(json.dumps(chunking))
+
+    # every chunk saves its output, even without any selected events
+    saved = {_chunk_key(path.name) for path in Path(parquet_dir).glob("*.parquet")}
+    for path in checkpoint_dir.glob("*.pkl"):
+        if _chunk_key(path.name) not in saved:
+            path.unlink()
+
+    completed = {_chunk_key(path.name) for path in checkpoint_dir.glob("*.pkl")}
+    for path in Path(parquet_dir).glob("*.parquet"):
+        if _chunk_key(path.name) not in completed:
+            path.unlink()
+
+    return len(completed)
+
+
+def with_checkpoints(
+    checkpoint_dir: str, automatic_retries, retries: int, skipbadfiles: bool, func, item
+):
+    """
+    Wraps ``automatic_retries``: saves the output of each completed chunk to ``checkpoint_dir``,
+    and returns the saved output instead of reprocessing chunks which have a checkpoint.
+    """
+    chunk = _work_item(item)
+    if not isinstance(chunk, WorkItem):
+        # preprocessing
+        return automatic_retries(retries, skipbadfiles, func, item)
+
+    path = checkpoint_path(checkpoint_dir, chunk)
+    if path.exists():
+        with path.open("rb") as f:
+            return pickle.load(f)["out"]
+
+    out = automatic_retries(retries, skipbadfiles, func, item)
+
+    if out is not None:
+        # write to a temporary file first so a checkpoint is never partially written
+        tmp_path = path.with_suffix(".tmp")
+        with tmp_path.open("wb") as f:
+            pickle.dump(
+                {
+                    "filename": chunk.filename,
+                    "entrystart": chunk.entrystart,
+                    "entrystop": chunk.entrystop,
+                    "out": out,
+                },
+                f,
+            )
+        tmp_path.replace(path)
+
+    return out
+
+
+def with_chunk_stats(automatic_retries, retries: int, skipbadfiles: bool, func, item):
+    """
+    Wraps ``automatic_retries``: adds the number of entries, wall time (s), and RSS before /
+    peak RSS during (MB) each chunk to its metrics, as ``metrics["chunk_stats"]``.
+    """
+    chunk = _work_item(item)
+    if not isinstance(chunk, WorkItem):
+        return automatic_retries(retries, skipbadfiles, func, item)
+
+    reset_peak_rss()
+    rss = get_rss()
+    tic = time.perf_counter()
+    out = automatic_retries(retries, skipbadfiles, func, item)
+    toc = time.perf_counter()
+
+    if out is not None and "metrics" in out:
+        out["metrics"]["chunk_stats"] = [
+            {
+                "entries": chunk.entrystop - chunk.entrystart,
+                "time": toc - tic,
+                "rss": rss,
+                "peak_rss": max(get_peak_rss(), rss),
+            }
+        ]
+
+    return out
+
+
+@dataclass
+class ChunksizeController:
+    """
+    Chooses the size of the next chunks from the time and memory measured for the previous ones,
+    aiming for ``target_time`` (s) and ``target_memory`` (MB) per chunk, the increase of the
+    peak RSS during the chunk over the RSS before it.
+
+    Time and memory are assumed to scale linearly with the number of entries. The RSS before
+    the chunk (e.g. of the accumulator or a fragmented heap) is not budgeted, as it doesn't
+    shrink with the chunksize. The chunksize changes by at most ``max_step`` times per update, and
+    is kept within [``min_chunksize``, ``max_chunksize``].
+    """
+
+    chunksize: int = 10000
+    target_time: float = 30.0
+    target_memory: float = 1000.0
+    min_chunksize: int = 1000
+    max_chunksize: int = 500000
+    max_step: float = 2.0
+    history: list = field(default_factory=list)
+
+    def update(self, chunk_stats: list[dict]) -> int:
+        """
+        Updates and returns the chunksize given the ``chunk_stats`` of the last chunks, which
+        are missing for skipped chunks (the chunksize is then kept)
+        """
+        entries = sum(s["entries"] for s in chunk_stats or [])
+        if entries == 0:
+            return self.chunksize
+
+        time_per_entry = sum(s["time"] for s in chunk_stats) / entries
+        # the largest memory per entry of the chunks, as memory is a hard limit
+        memory_per_entry = max(
+            max(s["peak_rss"] - s["rss"], 0) / s["entries"] for s in chunk_stats if s["entries"]
+        )
+
+        chunksize = self.target_time / max(time_per_entry, 1e-9)
+        if memory_per_entry > 0:
+            chunksize = min(chunksize, self.target_memory / memory_per_entry)
+
+        chunksize = min(
+            max(chunksize, self.chunksize / self.max_step), self.chunksize * self.max_step
+        )
+        self.chunksize = int(min(max(chunksize, self.min_chunksize), self.max_chunksize))
+        return self.chunksize
+
+
+@dataclass
+class Runner(processor.Runner):
+    """
+    ``coffea.processor.Runner`` which retries reading errors per file / chunk with exponential
+    backoff, failing over to other replicas of the file (``replicas``: lfn -> list of urls).
+
+    Args:
+        replicas (dict, optional): alternative urls for each file, keyed by logical file name
+        max_retries (int, optional): retries per replica
+        backoff (float, optional): wait before the first retry (in s), doubled for each following
+        max_backoff (float, optional): maximum wait between retries (in s)
+        checkpoint_dir (str, optional): directory in which the output of each completed chunk
+          is saved. Chunks with a checkpoint are not processed again (e.g. after an eviction).
+        metadata_cache (MutableMapping, optional): as in coffea; a ``MetadataCache`` is saved
+          after the preprocessing, to be reused by later runs.
+        chunksize_controller (ChunksizeController, optional): adapt the chunksize between chunks.
+          Chunks are then processed in waves of one chunk per worker, and the chunksizes used
+          are reported in ``metrics["chunksizes"]``. Requires ``savemetrics``.
+    """
+
+    replicas: dict = field(default_factory=dict)
+    max_retries: int = 3
+    backoff: float = 10.0
+    max_backoff: float = 300.0
+    checkpoint_dir: str = None
+    chunksize_controller: ChunksizeController = None
+
+    def __post_init__(self):
+        super().__post_init__()
+        if self.chunksize_controller is not None:
+            if not self.savemetrics:
+                raise ValueError("An adaptive chunksize requires savemetrics")
+            if self.maxchunks is not None:
+                raise ValueError("An adaptive chunksize is incompatible with maxchunks")
+            self.chunksize = self.chunksize_controller.chunksize
+
+        # coffea wraps each preprocessing and processing call with ``self.automatic_retries``
+        self.automatic_retries = partial(
+            retry_with_failover, self.replicas, self.max_retries, self.backoff, self.max_backoff
+        )
+        self.automatic_retries = partial(with_chunk_stats, self.automatic_retries)
+
+        if self.checkpoint_dir is not None:
+            Path(self.checkpoint_dir).mkdir(parents=True, exist_ok=True)
+            self.automatic_retries = partial(
+                with_checkpoints, self.checkpoint_dir, self.automatic_retries
+            )
+
+    def preprocess(self, fileset, treename):
+        chunks = super().preprocess(fileset, treename)
+        # persist the metadata of the newly preprocessed files
+        if hasattr(self.metadata_cache, "save"):
+            self.metadata_cache.save()
+        return chunks
+
+    @property
+    def nworkers(self) -> int:
+        if isinstance(self.executor, DaskExecutor):
+            return max(len(self.executor.client.scheduler_info()["workers"]), 1)
+        return getattr(self.executor, "workers", 1)
+
+    def run(self, fileset, processor_instance, treename=None):
+        if self.chunksize_controller is None or not isinstance(fileset, (Mapping, str)):
+            return super().run(fileset, processor_instance, treename)
+
+        controller = self.chunksize_controller
+        chunks = self.preprocess(fileset, treename)
+        nworkers = self.nworkers
+        wrapped_out, exception = None, None
+
+        # coffea's chunk generator accepts the size of the following chunks via ``send``
+        chunksize, done = None, False
+        while not done:
+            wave = []
+            try:
+                wave.append(chunks.send(chunksize))
+                while len(wave) < nworkers:
+                    wave.append(next(chunks))
+            except StopIteration:
+                done = True
+
+            if not wave:
+                break
+
+            controller.history.append(controller.chunksize)
+            try:
+                out = super().run(wave, processor_instance)
+            except ValueError as e:
+                # all the chunks of the wave were skipped (``skipbadfiles``)
+                if not str(e).startswith("No chunks returned results"):
+                    raise
+                out = None
+
+            stats = [] if out is None else out["metrics"].get("chunk_stats", [])
+            chunksize = controller.update(stats)
+            if stats:
+                print(
+                    f"Processed {len(wave)} chunk(s) of ~{controller.history[-1]} entries in "
+                    f"{max(s['time'] for s in stats):.1f}s, peak RSS "
+                    f"{max(s['peak_rss'] for s in stats):.0f} MB; next chunksize {chunksize}"
+                )
+            else:
+                print(f"No results from {len(wave)} chunk(s); next chunksize {chunksize}")
+
+            if out is not None:
+                exception = out.pop("exception") or exception
+                wrapped_out = (
+                    out if wrapped_out is None else processor.accumulate([wrapped_out, out])
+                )
+
+        if wrapped_out is None:
+            raise ValueError("No chunks returned results")
+
+        wrapped_out["exception"] = exception
+        metrics = wrapped_out["metrics"]
+        metrics["columns"] = sorted(set(metrics["columns"]))
+        metrics["chunksizes"] = controller.history
+        return wrapped_out
@@ -9,110 +9,195 @@ from __future__ import annotations
 import argparse
 import os
 import pickle
+import time
+from functools import partial
 from pathlib import Path
 
-import numpy as np
-import uproot
 import yaml
-from coffea import nanoevents, processor
+from coffea import processor
 
 from hpt import run_utils
 from hpt.common_vars import DATA_SAMPLES
-
-def run(p: processor, fileset: dict, skipbadfiles: bool, args):
-    """Run processor without fancy dask (outputs then need to be accumulated manually)"""
-    run_utils.add_mixins(nanoevents)  # update nanoevents schema
+from hpt.metadata_cache import MetadataCache
+from hpt.runner import ChunksizeController, Runner, prepare_checkpoints
+
+def run(
+    p: processor, fileset: dict, skipbadfiles: bool, args, client=None, replicas: dict = None
+):
+    """
+    Run processor (outputs then need to be accumulated manually).
+    ``client`` is the dask client to use with the dask executor.
+    ``replicas`` are alternative urls for the input files, keyed by logical file name.
+
+    Returns the output and the metrics of the run.
+    """
+    replicas = replicas if replicas is not None else {}
+    # update nanoevents schema and the uproot xrootd source
+    setup_worker = partial(run_utils.setup_worker, args.file_cache, args.file_cache_size)
+    setup_worker()
 
     # outputs are saved here as pickles
     outdir = "./outfiles"
     os.system(f"mkdir -p {outdir}")
 
+    # outputs of completed chunks are saved here, to resume from after e.g. an eviction
+    # (on condor, it links to the top-level job directory, which is restored after an eviction)
+    checkpoint_dir = Path("./checkpoints").resolve()
+    if checkpoint_dir.is_dir() and not args.resume:
+        os.system(f"rm -rf {checkpoint_dir}")
+
     save_parquet = True
-    save_root = False
+    save_root = args.save_root
 
     if save_parquet or save_root:
         # these processors store intermediate files in the "./outparquet" local directory
         local_dir = Path().resolve()
-        local_parquet_dir = local_dir / "outparquet"
+        local_parquet_dir = (local_dir / "outparquet").resolve()
 
-        if local_parquet_dir.is_dir():
+        # keep the outputs of the completed chunks if resuming
+        if local_parquet_dir.is_dir() and not args.resume:
             os.system(f"rm -rf {local_parquet_dir}")
 
-        local_parquet_dir.mkdir()
+        local_parquet_dir.mkdir(exist_ok=True)
 
-    uproot.open.defaults["xrootd_handler"] = uproot.source.xrootd.MultithreadedXRootDSource
+    # only the checkpoints of chunks with the same boundaries are reused, removing the outputs
+    # of the other chunks, which the new chunks would overlap
+    ncompleted = prepare_checkpoints(
+        checkpoint_dir,
+        local_parquet_dir,
+        {"chunksize": args.chunksize, "adaptive": args.adaptive_chunksize},
+    )
+    if args.resume:
+        print(f"Resuming with {ncompleted} completed chunks")
 
-    if args.executor == "futures":
+    pool = None
+    if args.executor == "dask":
+        executor = processor.DaskExecutor(client=client, status=True)
+    elif args.executor == "futures":
         executor = processor.FuturesExecutor(status=True)
+    elif args.executor == "processes":
+        pool = run_utils.RecyclingProcessPool(
+            args.workers,
+            max_tasks=args.max_chunks_per_worker or None,
+            max_rss=args.max_worker_rss or None,
+            initializer=setup_worker,
+        )
+        executor = processor.FuturesExecutor(pool=pool, workers=args.workers, status=True)
     else:
         executor = processor.IterativeExecutor(status=True)
 
-    run = processor.Runner(
+    controller = None
+    if args.adaptive_chunksize:
+        controller = ChunksizeController(
+            chunksize=args.chunksize,
+            target_time=args.target_chunk_time,
+            target_memory=args.target_chunk_memory,
+            min_chunksize=args.min_chunksize,
+            max_chunksize=args.max_chunksize,
+        )
+
+    run = Runner(
         executor=executor,
         savemetrics=True,
-        schema=nanoevents.NanoAODSchema,
+        schema=run_utils.get_schema(args.processor, args.prune_branches),
         chunksize=args.chunksize,
         maxchunks=None if args.maxchunks == 0 else args.maxchunks,
         skipbadfiles=skipbadfiles,
+        replicas=replicas,
+        max_retries=args.retries,
+        backoff=args.retry_backoff,
+        checkpoint_dir=str(checkpoint_dir),
+        metadata_cache=MetadataCache(args.metadata_cache) if args.metadata_cache else None,
+        chunksize_controller=controller,
     )
 
-    # try file opening 3 times if it fails
-    for i in range(3):
-        try:
-            out, metrics = run(fileset, "Events", processor_instance=p)
-            break
-        except FileNotFoundError as e:
-            import time
-
-            print("Error!")
-            print(e)
-            if i < 2:
-                print("Retrying in 1 minute")
-                time.sleep(60)
-            else:
-                raise e
+    if save_root:
+        # writes the chunks into the ROOT ntuple as they are produced
+        root_writer = run_utils.RootWriter(
+            local_parquet_dir, f"{local_dir}/nano_skim_{args.starti}-{args.endi}.root"
+        )
+        root_writer.start()
+
+    # read errors are retried per file / chunk, failing over to other replicas
+    try:
+        out, metrics = run(fileset, "Events", processor_instance=p)
+    finally:
+        # also stop the worker processes if the processing failed
+        if pool is not None:
+            pool.shutdown()
+
+    if pool is not None:
+        print(f"Recycled {pool.nrecycled} worker processes")
+
+    if args.adaptive_chunksize:
+        print(f"Chunksizes: {metrics['chunksizes']}")
+
+    print("Processing time per stage (s):")
+    print(run_utils.timing_summary(out).round(2).to_string())
+
+    if args.profile_memory:
+        # missing e.g. for the checkpoints of a run without --profile-memory
+        metrics["memory"] = {
+            f"{year}_{dataset}": dataset_out["memory"]
+            for year, year_out in out.items()
+            for dataset, dataset_out in year_out.items()
+            if "memory" in dataset_out
+        }
+        print("Peak memory (MB):")
+        print(run_utils.memory_summary(out).round(1).T.to_string())
 
     with Path(f"{outdir}/{args.starti}-{args.endi}.pkl").open("wb") as f:
         pickle.dump(out, f)
 
     # need to combine all the files from these processors before transferring to EOS
     # otherwise it will complain about too many small files
-    if save_parquet or save_root:
-        import pandas as pd
-        import pyarrow as pa
-        import pyarrow.parquet as pq
+    if save_parquet:
+        # stream the chunks into one file to keep the memory usage to ~one row group
+        start = time.perf_counter()
+        run_utils.merge_parquet(
+            local_parquet_dir,
+            f"{local_dir}/{args.starti}-{args.endi}.parquet",
+            row_group_size=args.row_group_size if args.row_group_size else args.chunksize,
+        )
+        metrics["merge_time"] = time.perf_counter() - start
 
-        pddf = pd.read_parquet(local_parquet_dir)
+    if save_root:
+        root_writer.close()
 
-        if save_parquet:
-            # need to write with pyarrow as pd.to_parquet doesn't support different types in
-            # multi-index column names
-            table = pa.Table.from_pandas(pddf)
-            pq.write_table(table, f"{local_dir}/{args.starti}-{args.endi}.parquet")
+    return out, metrics
 
-        if save_root and args.save_root:
-            import awkward as ak
 
-            with uproot.recreate(
-                f"{local_dir}/nano_skim_{args.starti}-{args.endi}.root", compression=uproot.LZ4(4)
-            ) as rfile:
-                rfile["Events"] = ak.Array(
-                    # take only top-level column names in multiindex df
-                    run_utils.flatten_dict(
-                        {key: np.squeeze(pddf[key].values) for key in pddf.columns.levels[0]}
-                    )
-                )
+def run_dask(p: processor, fileset: dict, skipbadfiles: bool, args, replicas: dict = None):
+    """Run processor on a local multi-core dask cluster, with the same outputs as ``run``"""
+    from distributed import Client, LocalCluster
+
+    with LocalCluster(
+        n_workers=args.workers,
+        threads_per_worker=args.threads_per_worker,
+        memory_limit=args.worker_memory,
+    ) as cluster, Client(cluster) as client:
+        # workers are separate processes and don't inherit the uproot / nanoevents settings
+        client.register_worker_callbacks(
+            setup=partial(run_utils.setup_worker, args.file_cache, args.file_cache_size)
+        )
+        print(client)
+        return run(p, fileset, skipbadfiles, args, client=client, replicas=replicas)
 
 
 def main(args):
     p = run_utils.get_processor(
         args.processor,
         args.save_array,
-        args.nano_version,
+        nano_version=args.nano_version,
+        arrow_output=args.arrow_output,
+        profile_memory=args.profile_memory,
+        pack_triggers=args.pack_triggers,
+        compact_dtypes=args.compact_dtypes,
     )
     print(p)
 
     skipbadfiles = True
+    replicas = {}
 
     if len(args.files):
         fileset = {f"{args.year}_{args.files_name}": args.files}
@@ -144,6 +229,8 @@ def main(args):
             args.endi,
         )
 
+        replicas = run_utils.get_replicas(args.nano_version)
+
         # don't skip "bad" files for data - we want it throw an error in that case
         for key in fileset:
             if key in DATA_SAMPLES:
@@ -151,23 +238,48 @@ def main(args):
 
     print(f"Running on fileset {fileset}")
     if args.executor == "dask":
-        run_dask(p, fileset, args)
-    else:
-        run(p, fileset, skipbadfiles, args)
+        return run_dask(p, fileset, skipbadfiles, args, replicas=replicas)
 
+    return run(p, fileset, skipbadfiles, args, replicas=replicas)
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    run_utils.parse_common_args(parser)
+
+def parse_args(parser):
     parser.add_argument("--starti", default=0, help="start index of files", type=int)
     parser.add_argument("--endi", default=-1, help="end index of files", type=int)
     parser.add_argument(
         "--executor",
         type=str,
         default="iterative",
-        choices=["futures", "iterative", "dask"],
+        choices=["futures", "iterative", "dask", "processes"],
         help="type of processor executor",
     )
+    parser.add_argument(
+        "--workers",
+        default=4,
+        help="number of local worker processes for the dask and processes executors",
+        type=int,
+    )
+    parser.add_argument(
+        "--threads-per-worker", default=1, help="threads per local dask worker", type=int
+    )
+    parser.add_argument(
+        "--worker-memory",
+        default="auto",
+        help="memory limit per local dask worker (e.g. '1GB', 'auto' splits the system memory)",
+        type=str,
+    )
+    parser.add_argument(
+        "--max-chunks-per-worker",
+        default=0,
+        help="processes executor: replace a worker process after this many chunks (0 = never)",
+        type=int,
+    )
+    parser.add_argument(
+        "--max-worker-rss",
+        default=0,
+        help="processes executor: replace a worker process once its RSS is above this (in MB)",
+        type=float,
+    )
     parser.add_argument(
         "--files", default=[], help="set of files to run on instead of samples", nargs="*"
     )
@@ -178,7 +290,72 @@ if __name__ == "__main__":
         help="sample name of files being run on, if --files option used",
     )
     parser.add_argument("--yaml", default=None, help="yaml file", type=str)
+    parser.add_argument(
+        "--retries", default=3, help="retries per replica of a file after read errors", type=int
+    )
+    parser.add_argument(
+        "--retry-backoff",
+        default=10.0,
+        help="seconds to wait before the first retry, doubled (with jitter) for each following",
+        type=float,
+    )
+    run_utils.add_bool_arg(
+        parser,
+        "resume",
+        default=False,
+        help="resume from the checkpoints of a previous run, skipping its completed chunks",
+    )
+    parser.add_argument(
+        "--file-cache",
+        default=None,
+        help="local directory in which to cache the xrootd input files, shared between workers "
+        "and reruns (by default files are read remotely)",
+        type=str,
+    )
+    parser.add_argument(
+        "--file-cache-size",
+        default=20.0,
+        help="size of the file cache (in GB), beyond which the least recently used files are "
+        "removed",
+        type=float,
+    )
+    run_utils.add_bool_arg(
+        parser,
+        "adaptive-chunksize",
+        default=False,
+        help="adapt the chunksize (starting from --chunksize) between chunks towards the target "
+        "time and memory per chunk. Chunk boundaries then differ between runs, so --resume "
+        "starts over",
+    )
+    parser.add_argument(
+        "--target-chunk-time",
+        default=30.0,
+        help="adaptive chunksize: seconds per chunk",
+        type=float,
+    )
+    parser.add_argument(
+        "--target-chunk-memory",
+        default=1000.0,
+        help="adaptive chunksize: increase of the worker's peak RSS during a chunk (in MB)",
+        type=float,
+    )
+    parser.add_argument(
+        "--min-chunksize", default=1000, help="adaptive chunksize: minimum chunksize", type=int
+    )
+    parser.add_argument(
+        "--max-chunksize", default=500000, help="adaptive chunksize: maximum chunksize", type=int
+    )
+    parser.add_argument(
+        "--row-group-size",
+        default=0,
+        help="row group size of the merged output parquet (0 = use the chunk size)",
+        type=int,
+    )
 
-    args = parser.parse_args()
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    run_utils.parse_common_args(parser)
+    parse_args(parser)
+    args = parser.parse_args()
     main(args)
@@ -0,0 +1,20 @@
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+
+@pytest.fixture(scope="session")
+def nano_file(tmp_path_factory) -> Path:
+    """Small synthetic NanoAOD file (see ``benchmarks/synthetic_nano.py``)"""
+    from synthetic_nano import make_nano
+
+    path = tmp_path_factory.mktemp("nano") / "data.root"
+    make_nano(str(path), 3000, "data")
+    return path
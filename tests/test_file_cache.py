@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import multiprocessing
+import os
+from pathlib import Path
+
+import pytest
+import uproot
+
+from hpt import file_cache
+from hpt.file_cache import CachedXRootDSource, FileCache
+
+# sizes in GB of the small test files
+KB = 1000 / 1024**3
+
+
+@pytest.fixture
+def remote(tmp_path) -> Path:
+    """Local directory standing in for the xrootd server"""
+    store = tmp_path / "remote" / "store" / "mc"
+    store.mkdir(parents=True)
+    for i, name in enumerate("abcd"):
+        (store / f"{name}.root").write_bytes(bytes([i]) * 1000)
+    return store
+
+
+@pytest.fixture
+def downloads(monkeypatch, tmp_path) -> Path:
+    """Log of the downloads, also of forked processes"""
+    log = tmp_path / "downloads.log"
+    log.touch()
+    download = file_cache.download
+
+    def logged_download(url, path):
+        with log.open("a") as f:
+            f.write(f"{url}\n")
+        download(url, path)
+
+    monkeypatch.setattr(file_cache, "download", logged_download)
+    return log
+
+
+def fetch(cache: FileCache, url: str) -> bytes:
+    with cache.fetch(str(url)) as path:
+        return Path(path).read_bytes()
+
+
+def cached(cache: FileCache) -> list[str]:
+    return sorted(p.stem.split("_", 1)[1] for p in cache.cache_dir.glob("*.root"))
+
+
+def test_lookup_key(remote, downloads, tmp_path, monkeypatch):
+    """Files are looked up by LFN, with no remote stat on a hit"""
+    cache = FileCache(tmp_path / "cache", 10 * KB)
+    replica = tmp_path / "replica" / "store" / "mc"
+    replica.mkdir(parents=True)
+    (replica / "a.root").write_bytes((remote / "a.root").read_bytes())
+
+    assert cache.path(str(remote / "a.root")) == cache.path(str(replica / "a.root"))
+    assert cache.path(str(remote / "a.root")) != cache.path(str(remote / "b.root"))
+    assert cache.path("root://cmsxrootd.fnal.gov//store/mc/a.root") == cache.path(
+        str(remote / "a.root")
+    )
+
+    assert fetch(cache, remote / "a.root") == bytes([0]) * 1000
+
+    def remote_size(url):
+        raise AssertionError("stat on a cache hit")
+
+    monkeypatch.setattr(file_cache, "remote_size", remote_size)
+    assert fetch(cache, replica / "a.root") == bytes([0]) * 1000
+    assert downloads.read_text().splitlines() == [str(remote / "a.root")]
+
+
+def test_incomplete_copy(remote, tmp_path, monkeypatch):
+    cache = FileCache(tmp_path / "cache", 10 * KB)
+    monkeypatch.setattr(file_cache, "download", lambda url, path: path.write_bytes(b"0"))
+    with pytest.raises(OSError, match="Incomplete copy"):
+        fetch(cache, remote / "a.root")
+    assert not list(cache.cache_dir.glob("*.root"))
+
+
+def test_lru_eviction(remote, downloads, tmp_path):
+    """The least recently used files are evicted beyond the size limit, with their lock files"""
+    cache = FileCache(tmp_path / "cache", 2.5 * KB)
+    fetch(cache, remote / "a.root")
+    fetch(cache, remote / "b.root")
+    fetch(cache, remote / "a.root")
+    assert cached(cache) == ["a", "b"]
+
+    fetch(cache, remote / "c.root")
+    assert cached(cache) == ["a", "c"]
+    locks = sorted(p.name for p in cache.cache_dir.glob("*.lock") if p.name != ".lock")
+    assert locks == sorted(cache.path(str(remote / f"{n}.root")).stem + ".lock" for n in "ac")
+
+    fetch(cache, remote / "b.root")
+    assert cached(cache) == ["b", "c"]
+    assert len(downloads.read_text().splitlines()) == 4
+
+
+def test_in_use_not_evicted(remote, tmp_path):
+    cache = FileCache(tmp_path / "cache", 1.5 * KB)
+    with cache.fetch(str(remote / "a.root")):
+        fetch(cache, remote / "b.root")
+        fetch(cache, remote / "c.root")
+        assert "a" in cached(cache)
+
+    fetch(cache, remote / "d.root")
+    assert cached(cache) == ["d"]
+
+
+def _fetch_worker(args) -> bytes:
+    cache_dir, url = args
+    return fetch(FileCache(cache_dir, 2.5 * KB), url)
+
+
+def test_concurrent_fills(remote, downloads, tmp_path):
+    """Processes filling the cache at once download each file once, and read complete copies"""
+    urls = [str(remote / f"{name}.root") for name in "ab"] * 8
+    with multiprocessing.get_context("fork").Pool(4) as pool:
+        contents = pool.map(_fetch_worker, [(tmp_path / "cache", url) for url in urls])
+
+    assert contents == [Path(url).read_bytes() for url in urls]
+    assert sorted(downloads.read_text().splitlines()) == sorted(set(urls))
+    assert not list((tmp_path / "cache").glob("*.tmp"))
+
+
+def test_cached_source(nano_file, tmp_path):
+    cache_dir = tmp_path / "cache"
+    options = {"file_cache": str(cache_dir), "file_cache_size": 1.0}
+    with uproot.open(str(nano_file), file_handler=CachedXRootDSource, **options) as f:
+        nevents = f["Events"].num_entries
+        assert len(list(cache_dir.glob("*.root"))) == 1
+
+    assert nevents == 3000
+    assert os.path.getsize(next(cache_dir.glob("*.root"))) == os.path.getsize(nano_file)
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import awkward as ak
+import numpy as np
+import pytest
+from coffea.nanoevents.methods import candidate
+
+from hpt.processors.matching import DeltaRTables, delta_r_table, no_overlap
+
+# invalid values in the ΔR of the NaN eta / phi
+pytestmark = pytest.mark.filterwarnings("ignore::RuntimeWarning")
+
+
+def candidates(
+    rng: np.random.Generator,
+    nevents: int,
+    max_per_event: int = 5,
+    nan_fraction: float = 0.1,
+    with_name: str = "PtEtaPhiMCandidate",
+    behavior: dict = candidate.behavior,
+    **fields: np.ndarray,
+) -> ak.Array:
+    """
+    Random jagged candidates, with many empty events, NaN eta / phi, and values from a small set
+    so that there are ties. ``fields`` are callables of the number of candidates.
+    """
+    counts = rng.integers(0, max_per_event + 1, nevents)
+    n = int(counts.sum())
+    eta = rng.choice(np.linspace(-2.5, 2.5, 11), n).astype(np.float32)
+    phi = rng.choice(np.linspace(-np.pi, np.pi, 13), n).astype(np.float32)
+    eta[rng.random(n) < nan_fraction] = np.nan
+    phi[rng.random(n) < nan_fraction] = np.nan
+    columns = {
+        "pt": rng.choice([30.0, 50.0, 300.0], n).astype(np.float32),
+        "eta": eta,
+        "phi": phi,
+        "mass": np.zeros(n, dtype=np.float32),
+        "charge": np.zeros(n, dtype=np.int32),
+        **{name: field(n) for name, field in fields.items()},
+    }
+    return ak.zip(
+        {name: ak.unflatten(column, counts) for name, column in columns.items()},
+        with_name=with_name,
+        behavior=behavior,
+    )
+
+
+def assert_identical(a: ak.Array, b: ak.Array):
+    """Same type and structure, and bit-identical values (NaNs included)"""
+    assert str(ak.type(a)) == str(ak.type(b))
+    assert ak.to_list(ak.nan_to_num(a, nan=np.inf)) == ak.to_list(ak.nan_to_num(b, nan=np.inf))
+    assert ak.to_list(ak.is_none(a, axis=-1)) == ak.to_list(ak.is_none(b, axis=-1))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_delta_r_table(seed):
+    """ΔR tables are the same as coffea's ``metric_table``"""
+    rng = np.random.default_rng(seed)
+    jets, partons = candidates(rng, 500), candidates(rng, 500, max_per_event=4)
+    assert_identical(delta_r_table(jets, partons), jets.metric_table(partons))
+
+    tables, table = DeltaRTables(), jets.metric_table(partons)
+    assert_identical(tables.any_within(jets, partons, 0.4), ak.any(table < 0.4, axis=2))
+    assert_identical(tables.count_within(jets, partons, 0.4), ak.sum(table < 0.4, axis=2))
+    assert_identical(tables.nearest(jets, partons), ak.argmin(table, axis=2))
+    assert_identical(tables.max(jets, partons), ak.max(table, axis=2))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_delta_r_table_grouped(seed):
+    """Grouped ΔR tables (e.g. b quarks per Higgs) are the same as coffea's ``metric_table``"""
+    rng = np.random.default_rng(seed)
+    jets, partons = candidates(rng, 500), candidates(rng, 500, max_per_event=4)
+
+    # random split of the partons of each event into up to 3 (possibly empty) groups, e.g. the
+    # b quarks per Higgs
+    groups = []
+    for n in ak.num(partons).to_numpy():
+        cuts = np.sort(rng.integers(0, n + 1, rng.integers(0, 3)))
+        groups.append(np.diff(np.concatenate([[0], cuts, [n]])).tolist())
+    groups = ak.Array(groups)
+
+    tables = DeltaRTables()
+    grouped = tables.grouped(jets, partons, groups)
+    # e.g. ``jets.metric_table(higgs.children)``, including empty groups
+    grouped_partons = ak.unflatten(
+        ak.unflatten(ak.flatten(partons), ak.flatten(groups)), ak.num(groups)
+    )
+    assert_identical(grouped, jets.metric_table(grouped_partons))
+    # cached, and sharing the ungrouped table
+    assert tables.grouped(jets, partons, groups) is grouped
+    assert_identical(tables(jets, partons), jets.metric_table(partons))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_no_overlap(seed):
+    """The same as and-ing ``metric_table``-based vetoes, also for ΔR exactly at the threshold"""
+    rng = np.random.default_rng(seed)
+    jets = candidates(rng, 500, max_per_event=6)
+    # ΔR of 0.5 between neighbouring etas of the same phi
+    vetoes = [(candidates(rng, 500, max_per_event=n), dr) for n, dr in [(2, 0.8), (3, 0.5), (1, 0)]]
+
+    expected = ak.ones_like(jets.pt, dtype=bool)
+    for collection, dr in vetoes:
+        expected = expected & ak.all(jets.metric_table(collection) > dr, axis=2)
+    assert_identical(no_overlap(jets, vetoes), expected)
+    fatjets, dr = vetoes[0]
+    assert_identical(
+        no_overlap(jets, [(fatjets, dr)]), ak.all(jets.metric_table(fatjets) > dr, axis=2)
+    )
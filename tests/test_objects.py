@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import awkward as ak
+import numpy as np
+import pytest
+from coffea.nanoevents.methods import nanoaod
+from test_matching import assert_identical, candidates
+
+from hpt.processors.objects import ak4_jets_awayfromak8, vbf_jets
+
+# invalid values in the ΔR of the NaN eta / phi
+pytestmark = pytest.mark.filterwarnings("ignore::RuntimeWarning")
+
+CUTS = {
+    "pt": 40,
+    "id": "tight",
+    "eta_max": 2.5,
+    "dr_fatjets": 0.8,
+    "dr_leptons": 0.4,
+    "electron_pt": 40,
+    "muon_pt": 40,
+}
+
+
+def objects(seed: int):
+    """Random jets, (0 to 2) fatjets and leptons, see ``test_matching.candidates``"""
+    rng = np.random.default_rng(seed)
+    nevents = 500
+    jets = candidates(
+        rng,
+        nevents,
+        max_per_event=6,
+        with_name="Jet",
+        behavior=nanoaod.behavior,
+        jetId=lambda n: rng.choice([0, 2, 6], n).astype(np.int32),
+        btagPNetB=lambda n: rng.choice([0.1, 0.5, 0.9], n).astype(np.float32),
+    )
+    fatjets = candidates(
+        rng, nevents, max_per_event=2, with_name="FatJet", behavior=nanoaod.behavior
+    )
+    events = ak.zip(
+        {
+            "Electron": candidates(rng, nevents, max_per_event=2),
+            "Muon": candidates(rng, nevents, max_per_event=2),
+        },
+        depth_limit=1,
+    )
+    return jets, fatjets, events
+
+
+def baseline_sel(jets, fatjets, events):
+    """The selection of the jets away from the fatjets and leptons with coffea's ``metric_table``"""
+    electrons = events.Electron[events.Electron.pt > CUTS["electron_pt"]]
+    muons = events.Muon[events.Muon.pt > CUTS["muon_pt"]]
+    return (
+        jets.isTight
+        & (jets.pt >= CUTS["pt"])
+        & (np.abs(jets.eta) <= CUTS["eta_max"])
+        & ak.all(jets.metric_table(fatjets) > CUTS["dr_fatjets"], axis=2)
+        & ak.all(jets.metric_table(electrons) > CUTS["dr_leptons"], axis=2)
+        & ak.all(jets.metric_table(muons) > CUTS["dr_leptons"], axis=2)
+    )
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_ak4_jets_awayfromak8_btag(seed):
+    """The (up to) two jets with the highest b-tag score, with ties keeping their order"""
+    jets, fatjets, events = objects(seed)
+    jets_away = jets[baseline_sel(jets, fatjets, events)]
+    expected = jets_away[ak.argsort(jets_away.btagPNetB, ascending=False, stable=True)][:, :2]
+    assert_identical(ak4_jets_awayfromak8(jets, fatjets, events, **CUTS), expected)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_ak4_jets_awayfromak8_nearest(seed):
+    """The jets nearest to each fatjet, also in events with fewer than two fatjets"""
+    jets, fatjets, events = objects(seed)
+    assert set(ak.num(fatjets).to_list()) == {0, 1, 2}
+
+    jets_away = jets[baseline_sel(jets, fatjets, events)]
+    expected = []
+    for fatjet in [ak.firsts(fatjets[:, 0:1]), ak.firsts(fatjets[:, 1:2])]:
+        order = ak.argsort(jets_away.delta_r(fatjet), ascending=True)
+        expected.append(jets_away[order][:, 0:1])
+
+    nearest = ak4_jets_awayfromak8(jets, fatjets, events, sort_by="nearest", **CUTS)
+    assert len(nearest) == 2
+    for jet, expected_jet in zip(nearest, expected):
+        assert_identical(jet, expected_jet)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_vbf_jets(seed):
+    jets, fatjets, events = objects(seed)
+    expected = jets[baseline_sel(jets, fatjets, events)][:, :2]
+    assert_identical(vbf_jets(jets, fatjets, events, **CUTS), expected)
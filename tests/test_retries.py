@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import errno
+import re
+import warnings
+from contextlib import contextmanager
+
+import numpy as np
+import pytest
+import uproot
+from coffea import processor
+from coffea.nanoevents import BaseSchema
+from coffea.processor.executor import UprootMissTreeError, WorkItem
+from test_runner import merged_events, run_job
+
+from hpt.runner import ChunksizeController, Runner, retry_with_failover
+
+pytestmark = pytest.mark.filterwarnings("ignore::RuntimeWarning")
+
+
+class FlakySource(uproot.source.file.MemmapSource):
+    """Local file source failing its first ``failures`` reads, like an unstable xrootd server"""
+
+    failures = 0
+
+    def _fail(self):
+        if FlakySource.failures > 0:
+            FlakySource.failures -= 1
+            raise OSError("XRootD error: [ERROR] Operation expired")
+
+    def chunk(self, start, stop):
+        self._fail()
+        return super().chunk(start, stop)
+
+    def chunks(self, ranges, notifications):
+        self._fail()
+        return super().chunks(ranges, notifications)
+
+
+@pytest.fixture
+def flaky_source(monkeypatch):
+    # coffea reads the chunks with ``uproot.MultithreadedFileSource``
+    monkeypatch.setitem(uproot.open.defaults, "file_handler", FlakySource)
+    monkeypatch.setattr(uproot, "MultithreadedFileSource", FlakySource)
+    yield FlakySource
+    FlakySource.failures = 0
+
+
+def chunk(filename: str) -> WorkItem:
+    return WorkItem("data", filename, "Events", 0, 1000, b"0" * 16)
+
+
+def num_entries(item: WorkItem) -> int:
+    with uproot.open(item.filename) as f:
+        return f[item.treename].num_entries
+
+
+def retry(func, item, replicas=None, skipbadfiles=False):
+    return retry_with_failover(replicas or {}, 2, 0.0, 0.0, 0, skipbadfiles, func, item)
+
+
+@contextmanager
+def warns(match: str):
+    """Like ``pytest.warns``, ignoring the other warnings"""
+    with warnings.catch_warnings(record=True) as record:
+        warnings.simplefilter("always")
+        yield
+    assert any(re.search(match, str(w.message)) for w in record), f"No warning matching {match}"
+
+
+def test_retry_flaky_source(nano_file, flaky_source):
+    flaky_source.failures = 2
+    with warns("Error reading"):
+        assert retry(num_entries, chunk(str(nano_file))) == 3000
+    assert flaky_source.failures == 0
+
+
+def test_failover(nano_file, flaky_source, tmp_path):
+    """After the retries on the first replica, the next replica is read"""
+    flaky_source.failures = 3
+    replica = tmp_path / "store" / "data.root"
+    replica.parent.mkdir()
+    replica.symlink_to(nano_file)
+    replicas = {"/store/data.root": [str(nano_file)]}
+    with warns("trying the next replica"):
+        assert retry(num_entries, chunk(str(replica)), replicas) == 3000
+
+
+def test_skip_missing_file(tmp_path):
+    with warns("Skipping"):
+        assert retry(num_entries, chunk(str(tmp_path / "missing.root")), skipbadfiles=True) is None
+
+
+@pytest.mark.parametrize("skipbadfiles", [True, False])
+def test_skip_missing_tree(tmp_path, skipbadfiles):
+    """As in coffea, files without the tree are skipped right away with ``skipbadfiles``"""
+    path = tmp_path / "notree.root"
+    with uproot.recreate(path) as f:
+        f["Other"] = {"x": np.arange(10)}
+
+    runner = Runner(executor=processor.IterativeExecutor(), skipbadfiles=skipbadfiles)
+    if skipbadfiles:
+        with warns("Skipping"):
+            assert list(runner.preprocess({"data": [str(path)]}, "Events")) == []
+    else:
+        with pytest.raises(UprootMissTreeError):
+            list(runner.preprocess({"data": [str(path)]}, "Events"))
+
+
+def test_output_errors_not_retried(nano_file):
+    """Errors which don't come from reading the input, e.g. writing the output, are raised"""
+    calls = []
+
+    def write_output(item):
+        calls.append(item)
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    with pytest.raises(OSError, match="No space left"):
+        retry(write_output, chunk(str(nano_file)), skipbadfiles=True)
+    assert len(calls) == 1
+
+
+def test_run_flaky_source(nano_file, flaky_source, tmp_path, monkeypatch):
+    """The job succeeds with the same output when reads fail a few times"""
+    monkeypatch.chdir(tmp_path)
+    run_job(nano_file, "--chunksize", "1000")
+    nevents = merged_events(tmp_path)
+
+    flaky_source.failures = 2
+    with warns("Error reading"):
+        run_job(nano_file, "--chunksize", "1000", "--retry-backoff", "0")
+    assert merged_events(tmp_path) == nevents
+
+
+class CountEvents(processor.ProcessorABC):
+    def process(self, events):
+        # reads a branch
+        return {"nevents": len(np.asarray(events.run))}
+
+    def postprocess(self, accumulator):
+        return accumulator
+
+
+def test_adaptive_skipped_wave(nano_file, monkeypatch):
+    """With an adaptive chunksize, waves of only skipped chunks don't stop the run"""
+    # only the chunks are read from the flaky source, not the metadata
+    monkeypatch.setattr(uproot, "MultithreadedFileSource", FlakySource)
+    FlakySource.failures = 2
+    runner = Runner(
+        executor=processor.IterativeExecutor(),
+        schema=BaseSchema,
+        savemetrics=True,
+        skipbadfiles=True,
+        chunksize=1000,
+        max_retries=1,
+        backoff=0.0,
+        chunksize_controller=ChunksizeController(chunksize=1000, max_chunksize=1000),
+    )
+    try:
+        with warns("Skipping"):
+            out, metrics = runner(
+                {"data": [str(nano_file)]}, "Events", processor_instance=CountEvents()
+            )
+    finally:
+        FlakySource.failures = 0
+
+    assert out["nevents"] == 2000
+    assert metrics["chunksizes"] == [1000] * 3
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import concurrent.futures
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import uproot
+
+from hpt import run_utils
+from hpt.processors.SkimmerABC import SkimmerABC
+
+
+@pytest.mark.parametrize("nevents", [1, 5])
+def test_root_writer(tmp_path, nevents):
+    """Chunks are written to the ROOT file, including chunks of a single event and booleans"""
+    parquet_dir = tmp_path / "outparquet"
+    parquet_dir.mkdir()
+    for i in range(2):
+        table = pa.table(
+            {
+                "GenVEta": np.full(nevents, i, dtype=np.float64),
+                "ak8FatJetPt": pa.FixedSizeListArray.from_arrays(
+                    np.arange(2 * nevents, dtype=np.float32), 2
+                ),
+                # e.g. with --compact-dtypes
+                "bbFatJetHiggsMatch": pa.FixedSizeListArray.from_arrays(
+                    np.arange(2 * nevents) % 2 == 0, 2
+                ),
+            }
+        )
+        pq.write_table(table, parquet_dir / f"chunk{i}.parquet")
+
+    writer = run_utils.RootWriter(parquet_dir, str(tmp_path / "out.root"))
+    writer.start()
+    writer.close()
+
+    assert writer.nevents == 2 * nevents
+    with uproot.open(tmp_path / "out.root") as f:
+        arrays = f["Events"].arrays(library="np")
+    assert arrays["GenVEta"].tolist() == [0] * nevents + [1] * nevents
+    assert arrays["ak8FatJetPt1"].tolist() == list(range(1, 2 * nevents, 2)) * 2
+    assert arrays["bbFatJetHiggsMatch0"].tolist() == [True] * (2 * nevents)
+    assert arrays["bbFatJetHiggsMatch1"].tolist() == [False] * (2 * nevents)
+
+
+def skimmed(nevents: int, mc: bool, trigger: bool) -> dict[str, np.ndarray]:
+    events = {
+        "ak8FatJetPt": np.arange(2 * nevents, dtype=np.float32).reshape(nevents, 2),
+        # triggers missing from a file are saved as booleans
+        "AK8PFJet420_MassSD30": np.ones(nevents, dtype=np.int32 if trigger else bool),
+        "weight": np.ones(nevents),
+    }
+    if mc:
+        events["GenHiggsPt"] = np.full((nevents, 2), 125.0)
+    return events
+
+
+@pytest.mark.parametrize("arrow", [False, True])
+def test_merge_parquet_different_columns(tmp_path, arrow):
+    """Files with different columns (e.g. data and MC in one job) are merged, filling in nulls"""
+    parquet_dir = tmp_path / "outparquet"
+    parquet_dir.mkdir()
+    # the first file (the data) lacks the gen variables
+    for i, (mc, trigger) in enumerate([(False, True), (True, False), (True, True)]):
+        events = skimmed(3 + i, mc, trigger)
+        if arrow:
+            table = pa.Table.from_batches([SkimmerABC.to_arrow(None, events)])
+        else:
+            table = pa.Table.from_pandas(SkimmerABC.to_pandas(None, events))
+        pq.write_table(table, parquet_dir / f"chunk{i}.parquet")
+
+    out_file = tmp_path / "merged.parquet"
+    assert run_utils.merge_parquet(parquet_dir, out_file, row_group_size=4) == 12
+
+    table = pq.read_table(out_file)
+    if arrow:
+        gen, trigger = table.column("GenHiggsPt"), table.column("AK8PFJet420_MassSD30")
+        assert gen.combine_chunks().flatten().null_count == 2 * 3
+    else:
+        # pandas' multi-index column names
+        gen = table.column("('GenHiggsPt', '0')")
+        trigger = table.column("('AK8PFJet420_MassSD30', '0')")
+        assert gen.null_count == 3
+    assert trigger.type == pa.int32()
+    assert trigger.to_pylist() == [1] * 12
+    if not arrow:
+        expected = pd.concat(
+            [pd.read_parquet(fname) for fname in sorted(parquet_dir.glob("*.parquet"))],
+            ignore_index=True,
+        )
+        merged = pd.read_parquet(out_file)
+        pd.testing.assert_frame_equal(merged, expected[merged.columns], check_dtype=False)
+        assert set(merged.columns) == set(expected.columns)
+
+
+class InlineWorker(concurrent.futures.Executor):
+    """Worker running the tasks in the calling thread, so they're done before ``submit`` returns"""
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = concurrent.futures.Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+class BrokenWorker(concurrent.futures.Executor):
+    def submit(self, fn, /, *args, **kwargs):
+        raise BrokenProcessPool("worker died")
+
+
+class InlinePool(run_utils.RecyclingProcessPool):
+    def __init__(self, *args, workers=(), **kwargs):
+        self._next_workers = list(workers)
+        super().__init__(*args, **kwargs)
+
+    def _new_worker(self):
+        return self._next_workers.pop(0) if self._next_workers else InlineWorker()
+
+
+def submit_all(pool, n: int) -> list:
+    """Submits ``n`` tasks from another thread, failing instead of hanging on a deadlock"""
+    futures = []
+    thread = threading.Thread(
+        target=lambda: futures.extend(pool.submit(pow, i, 2) for i in range(n)), daemon=True
+    )
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), "deadlock"
+    return futures
+
+
+def test_pool_tasks_done_at_submit():
+    pool = InlinePool(2, max_tasks=2)
+    futures = submit_all(pool, 5)
+    assert [f.result(timeout=1) for f in futures] == [0, 1, 4, 9, 16]
+    assert pool.nrecycled == 2
+
+
+def test_pool_broken_worker():
+    """Tasks failing to be sent to a worker fail, and the worker is replaced"""
+    pool = InlinePool(1, workers=[BrokenWorker()])
+    futures = submit_all(pool, 2)
+    with pytest.raises(BrokenProcessPool):
+        futures[0].result(timeout=1)
+    assert futures[1].result(timeout=1) == 1
+    assert pool.nrecycled == 1
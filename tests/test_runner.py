@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+import argparse
+import pickle
+import shutil
+from pathlib import Path
+
+import pyarrow.parquet as pq
+import pytest
+import run
+import uproot
+
+from hpt import run_utils
+from hpt.runner import ChunksizeController, prepare_checkpoints
+
+# coffea warns about the cross-references missing from the synthetic files
+pytestmark = pytest.mark.filterwarnings("ignore::RuntimeWarning")
+
+
+def run_job(path: Path, *args: str):
+    """Runs ``run.py`` on the synthetic file ``path`` in the working directory"""
+    parser = argparse.ArgumentParser()
+    run_utils.parse_common_args(parser)
+    run.parse_args(parser)
+    args = parser.parse_args(
+        [
+            "--processor",
+            "ptSkimmer",
+            "--year",
+            "2023",
+            "--files",
+            str(path),
+            "--nano-version",
+            "v12",
+            "--files-name",
+            "JetMET",
+            *args,
+        ]
+    )
+    return run.main(args)
+
+
+def merged_events(workdir: Path) -> int:
+    return pq.read_metadata(workdir / "0--1.parquet").num_rows
+
+
+@pytest.mark.parametrize("chunksize", ["1000", "700"])
+def test_resume(nano_file, tmp_path, monkeypatch, chunksize):
+    """Resuming after an eviction gives the same output, also with other chunk boundaries"""
+    monkeypatch.chdir(tmp_path)
+    run_job(nano_file, "--chunksize", "1000")
+    nevents = merged_events(tmp_path)
+    assert nevents > 0
+
+    # evicted before the checkpoint of the last chunk was saved
+    checkpoints = sorted((tmp_path / "checkpoints").glob("*.pkl"))
+    assert len(checkpoints) == 3
+    checkpoints[-1].unlink()
+
+    run_job(nano_file, "--chunksize", chunksize, "--resume")
+    assert merged_events(tmp_path) == nevents
+
+    nchunks = len(list((tmp_path / "outparquet").glob("*.parquet")))
+    assert nchunks == 3 if chunksize == "1000" else 4
+
+
+def test_resume_lost_output(nano_file, tmp_path, monkeypatch):
+    """Chunks whose output was lost are processed again, despite their checkpoint"""
+    monkeypatch.chdir(tmp_path)
+    run_job(nano_file, "--chunksize", "1000")
+    nevents = merged_events(tmp_path)
+
+    outputs = sorted((tmp_path / "outparquet").glob("*.parquet"))
+    outputs[0].unlink()
+    run_job(nano_file, "--chunksize", "1000", "--resume")
+    assert merged_events(tmp_path) == nevents
+    assert len(list((tmp_path / "checkpoints").glob("*.pkl"))) == 3
+
+
+def test_resume_condor_layout(nano_file, tmp_path, monkeypatch):
+    """
+    As in the condor jobs, the checkpoints and per-chunk outputs are linked from the top-level
+    job directory, which is restored after an eviction, while the cloned repo is not
+    """
+
+    def clone():
+        repo = tmp_path / "hpt"
+        repo.mkdir()
+        for name in ["checkpoints", "outparquet"]:
+            (tmp_path / name).mkdir(exist_ok=True)
+            (repo / name).symlink_to(Path("..") / name)
+        monkeypatch.chdir(repo)
+        return repo
+
+    repo = clone()
+    run_job(nano_file, "--chunksize", "1000")
+    nevents = merged_events(repo)
+    assert len(list((tmp_path / "checkpoints").glob("*.pkl"))) == 3
+    assert len(list((tmp_path / "outparquet").glob("*.parquet"))) == 3
+
+    # evicted before the checkpoint of the last chunk was saved
+    sorted((tmp_path / "checkpoints").glob("*.pkl"))[-1].unlink()
+    shutil.rmtree(repo)
+    repo = clone()
+    run_job(nano_file, "--chunksize", "1000", "--resume")
+    assert merged_events(repo) == nevents
+    assert len(list((tmp_path / "outparquet").glob("*.parquet"))) == 3
+
+
+def test_resume_profile_memory(nano_file, tmp_path, monkeypatch):
+    """Resuming with --profile-memory from checkpoints saved without it"""
+    monkeypatch.chdir(tmp_path)
+    run_job(nano_file, "--chunksize", "1000")
+    nevents = merged_events(tmp_path)
+
+    run_job(nano_file, "--chunksize", "1000", "--resume", "--profile-memory")
+    assert merged_events(tmp_path) == nevents
+    with (tmp_path / "outfiles" / "0--1.pkl").open("rb") as f:
+        out = pickle.load(f)
+    assert "memory" not in out["2023"]["JetMET"]
+
+
+def test_prepare_checkpoints_adaptive(tmp_path):
+    """Checkpoints of an adaptive chunksize are never reused, nor their outputs merged"""
+    checkpoint_dir, parquet_dir = tmp_path / "checkpoints", tmp_path / "outparquet"
+    parquet_dir.mkdir()
+    chunking = {"chunksize": 1000, "adaptive": True}
+    assert prepare_checkpoints(checkpoint_dir, parquet_dir, chunking) == 0
+
+    uuid = "b3135e22-cafa-11f1-8e99-02fc00000001"
+    (checkpoint_dir / f"{uuid.replace('-', '')}_Events_0-1000.pkl").touch()
+    (parquet_dir / f"{uuid}_%2FEvents%3B1_0-1000.parquet").touch()
+    (parquet_dir / f"{uuid}_%2FEvents%3B1_1000-2500.parquet").touch()
+
+    assert prepare_checkpoints(checkpoint_dir, parquet_dir, chunking) == 0
+    assert not list(checkpoint_dir.glob("*.pkl"))
+    assert not list(parquet_dir.glob("*.parquet"))
+
+    # with a fixed chunksize, only the outputs without a checkpoint and the checkpoints without
+    # an output are removed
+    chunking = {"chunksize": 1000, "adaptive": False}
+    prepare_checkpoints(checkpoint_dir, parquet_dir, chunking)
+    (checkpoint_dir / f"{uuid.replace('-', '')}_Events_0-1000.pkl").touch()
+    (parquet_dir / f"{uuid}_%2FEvents%3B1_0-1000.parquet").touch()
+    (parquet_dir / f"{uuid}_%2FEvents%3B1_1000-2000.parquet").touch()
+    (checkpoint_dir / f"{uuid.replace('-', '')}_Events_2000-3000.pkl").touch()
+    assert prepare_checkpoints(checkpoint_dir, parquet_dir, chunking) == 1
+    kept = [p.stem for p in checkpoint_dir.glob("*.pkl")]
+    assert kept == [f"{uuid.replace('-', '')}_Events_0-1000"]
+    kept = [p.name for p in parquet_dir.glob("*.parquet")]
+    assert kept == [f"{uuid}_%2FEvents%3B1_0-1000.parquet"]
+
+
+def test_chunksize_controller_baseline_rss():
+    """The chunksize recovers when the RSS before the chunks is above the target"""
+    controller = ChunksizeController(
+        chunksize=10000, target_time=10.0, target_memory=500.0, min_chunksize=1000
+    )
+    stats = {"entries": 10000, "time": 1.0, "rss": 2000.0, "peak_rss": 2100.0}
+    for _ in range(5):
+        controller.update([stats])
+    # limited by the time (100000 entries) and the memory increase (50000 entries)
+    assert controller.chunksize == 50000
+
+    stats = {"entries": 50000, "time": 5.0, "rss": 1000.0, "peak_rss": 2000.0}
+    assert controller.update([stats]) == 25000
+
+    # skipped chunks have no stats
+    assert controller.update([]) == controller.update(None) == 25000
+
+
+def test_pool_shutdown_on_error(nano_file, tmp_path, monkeypatch):
+    """The worker processes are stopped also when the processing fails"""
+    monkeypatch.chdir(tmp_path)
+    shutdowns = []
+    shutdown = run_utils.RecyclingProcessPool.shutdown
+
+    def recorded_shutdown(self, *args, **kwargs):
+        shutdowns.append(self)
+        return shutdown(self, *args, **kwargs)
+
+    def failing_run(self, *args, **kwargs):
+        raise RuntimeError("processing failed")
+
+    monkeypatch.setattr(run_utils.RecyclingProcessPool, "shutdown", recorded_shutdown)
+    monkeypatch.setattr(run.Runner, "__call__", failing_run)
+    with pytest.raises(RuntimeError, match="processing failed"):
+        run_job(nano_file, "--executor", "processes", "--workers", "1")
+    assert len(shutdowns) == 1
+
+
+# coffea's PackedSelection in the gen selections of the MC
+@pytest.mark.filterwarnings("ignore:`np.bool` is a deprecated alias:DeprecationWarning")
+def test_compact_arrow_root(tmp_path, monkeypatch):
+    """The compact dtypes of the pyarrow output, incl. 2D booleans, are written to the ntuple"""
+    from synthetic_nano import DATASETS, make_nano
+
+    make_nano(str(tmp_path / "HHto4B.root"), 2000, "HHto4B")
+    monkeypatch.chdir(tmp_path)
+    run_job(
+        tmp_path / "HHto4B.root",
+        "--files-name",
+        DATASETS["HHto4B"],
+        "--chunksize",
+        "1000",
+        "--arrow-output",
+        "--compact-dtypes",
+        "--save-root",
+    )
+
+    with uproot.open(tmp_path / "nano_skim_0--1.root") as f:
+        events = f["Events"]
+        assert events.num_entries == merged_events(tmp_path) > 0
+        assert events["bbFatJetHiggsMatch1"].array(library="np").dtype == bool
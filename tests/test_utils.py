@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import awkward as ak
+import numpy as np
+import pytest
+
+from hpt.processors import utils
+
+
+@pytest.fixture
+def dicts():
+    """Two dicts with the same keys, one of which has a different dtype in each"""
+    rng = np.random.default_rng(42)
+    match = rng.integers(0, 2, size=(20, 1))
+    return [
+        {"pt": rng.normal(size=(20, 1)), "matched": match.astype(bool), "n": match},
+        {"pt": rng.normal(size=20), "matched": match, "n": match.astype(np.float32)},
+    ]
+
+
+def test_concatenate_dicts(dicts):
+    out = {}
+    for buffers in [None, out, out]:
+        concatenated = utils.concatenate_dicts(dicts, out=buffers)
+        for key, arr in concatenated.items():
+            expected = np.concatenate([d[key].reshape(20, -1) for d in dicts], axis=1)
+            assert arr.dtype == expected.dtype
+            np.testing.assert_array_equal(arr, expected)
+
+
+@pytest.mark.parametrize("sel_shape", [(20,), (20, 2)])
+def test_select_dicts(dicts, sel_shape):
+    sel = np.random.default_rng(1).uniform(size=sel_shape) < 0.5
+    out = {}
+    for buffers in [None, out, out]:
+        selected = utils.select_dicts(dicts, sel, out=buffers)
+        for key, arr in selected.items():
+            expected = np.stack([d[key].reshape(20, -1) for d in dicts], axis=1)[sel]
+            assert arr.dtype == expected.dtype
+            np.testing.assert_array_equal(arr, expected)
+
+
+@pytest.mark.parametrize("ascending", [False, True])
+@pytest.mark.parametrize("masked", [False, True])
+@pytest.mark.parametrize("k", [1, 2, 3])
+def test_top_k(k, masked, ascending):
+    """The same indices as a stable ``ak.argsort``, with NaNs, ties and empty events"""
+    rng = np.random.default_rng(k)
+    counts = rng.integers(0, 6, 1000)
+    flat = rng.choice([1.0, 2.0, 3.0, np.nan], counts.sum())
+    values = ak.unflatten(flat, counts)
+    mask = ak.unflatten(rng.random(len(flat)) < 0.7, counts) if masked else None
+
+    index = ak.local_index(values)
+    if masked:
+        index, values_sel = index[mask], values[mask]
+    else:
+        values_sel = values
+    expected = index[ak.argsort(values_sel, ascending=ascending, stable=True)][:, :k]
+
+    top = utils.top_k(values, k, mask, ascending=ascending)
+    assert ak.to_list(top) == ak.to_list(expected)